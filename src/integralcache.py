@@ -0,0 +1,169 @@
+"""This module implements a persistent, content-addressed cache for the
+results of the integrals computed by LattE.
+
+Each entry is a file in the cache folder, named after the hash of the
+exact LattE input and containing the result. Entries are written
+atomically, so that the cache can be shared by concurrent processes, and
+the least recently used ones are evicted when the cache grows larger
+than its maximum size.
+
+Each process keeps an approximate count of the entries, which is
+incremented by its own insertions. The folder is listed only when the
+count exceeds the maximum size, and the eviction then removes the
+entries down to a fraction EVICTION_RATIO of it. Hence an insertion
+costs O(1) file operations, plus O(N log N) for the eviction of a folder
+of N entries at most once every (1 - EVICTION_RATIO) * max_size
+insertions. Since the entries written by other processes are counted
+only by the eviction, a shared folder can temporarily exceed its maximum
+size.
+
+"""
+
+__version__ = '0.999'
+__author__ = 'Paolo Morettin'
+
+from hashlib import sha1
+from os import listdir, makedirs, remove, rename, utime, fdopen
+from os.path import exists, isdir, join, getmtime
+from tempfile import mkstemp
+
+from logger import Loggable
+
+
+class IntegralCache(Loggable):
+
+    # default maximum number of entries
+    DEF_MAX_SIZE = 100000
+    # fraction of the maximum size left by an eviction
+    EVICTION_RATIO = 0.9
+    # prefix of the partially written entries
+    TMP_PREFIX = ".tmp"
+    # content of the entries for which LattE didn't return a result
+    NO_RESULT = "None"
+
+    def __init__(self, path, max_size=None):
+        """Default constructor.
+
+        Keyword arguments:
+        path -- path of the cache folder, created if it doesn't exist
+        max_size -- maximum number of entries (optional)
+
+        """
+        self.init_sublogger(__name__)
+        self.path = path
+        self.max_size = max_size or IntegralCache.DEF_MAX_SIZE
+        # approximate number of entries, counted at the first insertion
+        self.size = None
+        if not isdir(path):
+            try:
+                makedirs(path)
+            except OSError:
+                # created concurrently by another process
+                if not isdir(path):
+                    raise
+
+    @staticmethod
+    def key(*inputs):
+        """Returns the key associated to the given input strings."""
+        digest = sha1()
+        for text in inputs:
+            digest.update(text)
+            digest.update("\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Returns a pair (hit, result), where hit is True iff the key is in
+        the cache and result is the cached value (possibly None).
+
+        Keyword arguments:
+        key -- the key of the entry
+
+        """
+        entry = join(self.path, key)
+        try:
+            with open(entry, 'r') as f:
+                content = f.read().strip()
+            # update the access time for the LRU eviction
+            utime(entry, None)
+        except (IOError, OSError):
+            return False, None
+
+        if content == IntegralCache.NO_RESULT:
+            return True, None
+        try:
+            return True, float(content)
+        except ValueError:
+            # corrupted entry
+            return False, None
+
+    def put(self, key, result):
+        """Stores the result of an integral in the cache, evicting the least
+        recently used entries if the approximate number of entries exceeds
+        the maximum size.
+
+        Keyword arguments:
+        key -- the key of the entry
+        result -- the result (float or None)
+
+        """
+        content = (IntegralCache.NO_RESULT if result is None
+                   else repr(float(result)))
+        entry = join(self.path, key)
+        new = not exists(entry)
+        try:
+            fd, tmp_path = mkstemp(prefix=IntegralCache.TMP_PREFIX,
+                                   dir=self.path)
+            with fdopen(fd, 'w') as f:
+                f.write(content)
+            # atomic, concurrent readers see either nothing or the full entry
+            rename(tmp_path, entry)
+        except (IOError, OSError) as e:
+            self.logger.warning("Couldn't write cache entry: {}".format(e))
+            return
+
+        if self.size is None:
+            self.size = len(self._names())
+        elif new:
+            self.size += 1
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Lists the cache folder and, if it has more entries than the
+        maximum size, removes the least recently used ones down to a
+        fraction EVICTION_RATIO of the maximum size. The cost is O(N log N)
+        for a folder of N entries.
+
+        """
+        names = self._names()
+        self.size = len(names)
+        if len(names) <= self.max_size:
+            return
+
+        entries = []
+        for name in names:
+            try:
+                entries.append((getmtime(join(self.path, name)), name))
+            except OSError:
+                # removed concurrently
+                continue
+
+        n_exceeding = len(entries) - int(self.max_size *
+                                         IntegralCache.EVICTION_RATIO)
+        self.size = len(entries)
+        if n_exceeding <= 0:
+            return
+
+        entries.sort()
+        for _, name in entries[:n_exceeding]:
+            try:
+                remove(join(self.path, name))
+            except OSError:
+                continue
+        self.size -= n_exceeding
+        self.logger.debug("Evicted {} cache entries".format(n_exceeding))
+
+    def _names(self):
+        # names of the entries in the cache folder
+        return [name for name in listdir(self.path)
+                if not name.startswith(IntegralCache.TMP_PREFIX)]
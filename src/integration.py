@@ -1,22 +1,33 @@
 """This module implements the class that handles the integration of
 polynomial functions over (convex) polytopes.
 
-LattE Integrale is required.
+LattE Integrale is required. Integrals over intervals, axis-aligned boxes,
+polygons and polytopes of moderate dimension are computed natively.
+If a relative error is given, the remaining integrals are estimated by Monte
+Carlo sampling instead of calling LattE.
 
 """
 
 __version__ = '0.999'
 __author__ = 'Paolo Morettin'
 
-from subprocess import call
-from os import makedirs, chdir, getcwd
-from os.path import isdir
+from subprocess import Popen
+from os.path import join
 from shutil import rmtree
+from tempfile import mkdtemp
 from fractions import Fraction
+from math import sqrt
+from time import sleep, time
 
+from integralcache import IntegralCache
+from linearprogramming import bounding_box, is_full_dimensional, \
+    redundant_rows, single_variable_bounds, LP_INFEASIBLE, LP_OPTIMAL
 from logger import Loggable
+import montecarlo
+import nativeintegration as native
 from pysmt2latte import Polynomial, Polytope
-from wmiexception import WMIRuntimeException
+from utils import LRUCache
+from wmiexception import WMIRuntimeException, WMITimeoutException
 
 class Integrator(Loggable):
 
@@ -27,94 +38,398 @@ class Integrator(Loggable):
     ALGORITHMS = [ALG_TRIANGULATE, ALG_CONE_DECOMPOSE]
 
 
-    # template name for the temporary folder
-    FOLDER_TEMPLATE = "latte_{}"
+    # template prefix for the temporary folder
+    FOLDER_TEMPLATE = "latte_{}_"
     # temporary files
     POLYTOPE_TEMPLATE = "polytope.hrep.latte"
     POLYNOMIAL_TEMPLATE = "polynomial.latte"
     OUTPUT_TEMPLATE = "output.txt"
 
-    def __init__(self, algorithm=None):        
+    # seconds between two checks of a LattE process with a deadline
+    POLL_DELTA = 0.05
+
+    # maximum dimension of the polytopes triangulated natively
+    DEF_MAX_NATIVE_DIMENSION = 3
+    # maximum number of integrals over blocks of variables kept in memory
+    DEF_BLOCK_CACHE_SIZE = 10000
+    # the redundant bounds are searched by linear programming only if there
+    # are more than REDUNDANCY_RATIO bounds per variable
+    REDUNDANCY_RATIO = 4
+
+    def __init__(self, algorithm=None, cache_path=None, cache_size=None,
+                 native=True, max_native_dimension=None, factorize=True,
+                 block_cache_size=None, remove_redundant=True):
+        """Default constructor.
+
+        Keyword arguments:
+        algorithm -- LattE algorithm, in Integrator.ALGORITHMS (optional)
+        cache_path -- folder of the persistent cache of the integrals, if
+            not specified the cache is disabled (optional)
+        cache_size -- maximum number of cached integrals (optional)
+        native -- if True, the integrals that can be computed exactly
+            in-process don't call LattE (default: True)
+        max_native_dimension -- polytopes up to this dimension are
+            triangulated and integrated natively (optional)
+        factorize -- if True, polytopes that are the product of polytopes
+            over disjoint blocks of variables are integrated block by block
+            (default: True)
+        block_cache_size -- maximum number of integrals over the blocks kept
+            in memory (optional)
+        remove_redundant -- if True, the bounds implied by the others are
+            found by linear programming and removed before calling LattE,
+            when there are more than REDUNDANCY_RATIO bounds per variable
+            (default: True)
+
+        """
         self.init_sublogger(__name__)
         self.algorithm = algorithm or Integrator.DEF_ALGORITHM
         assert(self.algorithm in Integrator.ALGORITHMS)
+        if cache_path:
+            self.cache = IntegralCache(cache_path, cache_size)
+        else:
+            self.cache = None
+        self.native = native
+        self.max_native_dimension = (max_native_dimension
+                                     if max_native_dimension != None
+                                     else Integrator.DEF_MAX_NATIVE_DIMENSION)
+        self.factorize = factorize
+        self.block_cache = LRUCache(block_cache_size or
+                                    Integrator.DEF_BLOCK_CACHE_SIZE)
+        self.remove_redundant = remove_redundant
             
 
     def integrate_raw(self, coefficients, rng, index=0):
-        # create a temporary folder containing the input and output files
-        # possibly removing an older one
-        folder = Integrator.FOLDER_TEMPLATE.format(index)
-        if isdir(folder):
-            rmtree(folder)
-            
-        makedirs(folder)        
-        polynomial_file = Integrator.POLYNOMIAL_TEMPLATE
-        polytope_file = Integrator.POLYTOPE_TEMPLATE
-        output_file = Integrator.OUTPUT_TEMPLATE        
-        # change the CWD and create the temporary files
-        original_cwd = getcwd()
-        chdir(folder)
+        """Integrates a univariate polynomial over an interval.
 
-        frac_coeffs = map(Fraction, coefficients)
+        Keyword arguments:
+        coefficients -- list of coefficients, in decreasing order of degree
+        rng -- pair (lower, upper) encoding the interval
 
-        with open(polynomial_file, 'w') as f:
-            f.write("[[{},[2]],[{},[1]],[{},[0]]]".format(*frac_coeffs))
+        """
+        if self.native:
+            return float(native.integrate_univariate(coefficients, rng))
+        else:
+            return self._integrate_raw_latte(coefficients, rng, index)
+
+    def integrate_raw_batch(self, coefficients_list, ranges):
+        """Integrates many univariate polynomials, each one over its interval,
+        returning the list of results.
+
+        Keyword arguments:
+        coefficients_list -- list of lists of coefficients, in decreasing
+            order of degree
+        ranges -- list of pairs (lower, upper) encoding the intervals
+
+        """
+        if self.native:
+            return map(float, native.integrate_univariate_batch(
+                coefficients_list, ranges))
+        else:
+            return [self._integrate_raw_latte(coefficients, rng, index)
+                    for index, (coefficients, rng)
+                    in enumerate(zip(coefficients_list, ranges))]
+
+    def _integrate_raw_latte(self, coefficients, rng, index):
+        frac_coeffs = map(Fraction, coefficients)
+        polynomial_repr = "[[{},[2]],[{},[1]],[{},[0]]]".format(*frac_coeffs)
 
         b1 = Fraction(rng[0]).denominator
         b2 = Fraction(rng[1]).denominator
         bound = [-Fraction(rng[0]).numerator, b1, Fraction(rng[1]).numerator, b2]
-        with open(polytope_file, 'w') as f:
-            f.write("2 2\n{} {}\n{} -{}".format(*bound))       
-            
-        # integrate and dump the result on file
-        self._call_latte(polynomial_file, polytope_file, output_file)
-        # read back the result and return to the original CWD
-        result = self._read_output_file(output_file)            
-        chdir(original_cwd)
-        # remove the temporary folder and files
-        rmtree(folder)        
+        polytope_repr = "2 2\n{} {}\n{} -{}".format(*bound)
+
+        return self._integrate_latte_repr(polynomial_repr, polytope_repr, index)
+
+    def _integrate_latte_repr(self, polynomial_repr, polytope_repr, index,
+                              info=None, deadline=None):
+        """Integrates the polynomial over the polytope, given in LattE format,
+        looking up the cache first. If info is given, counts the cache hits
+        and the LattE calls in it. If deadline is given, LattE is killed at
+        that time and WMITimeoutException is raised.
+
+        """
+        info = {} if info is None else info
+        if self.cache is not None:
+            key = IntegralCache.key(self.algorithm, polynomial_repr,
+                                    polytope_repr)
+            hit, result = self.cache.get(key)
+            if hit:
+                info["n_cache_hits"] = info.get("n_cache_hits", 0) + 1
+                return result
+
+        info["n_latte"] = info.get("n_latte", 0) + 1
+
+        # create a unique temporary folder containing the input and output
+        # files, the CWD is never changed so that concurrent calls are safe
+        folder = mkdtemp(prefix=Integrator.FOLDER_TEMPLATE.format(index))
+        try:
+            polynomial_file = join(folder, Integrator.POLYNOMIAL_TEMPLATE)
+            polytope_file = join(folder, Integrator.POLYTOPE_TEMPLATE)
+            output_file = join(folder, Integrator.OUTPUT_TEMPLATE)
+            with open(polynomial_file, 'w') as f:
+                f.write(polynomial_repr)
+            with open(polytope_file, 'w') as f:
+                f.write(polytope_repr)
+            # integrate and dump the result on file, LattE runs in the
+            # folder since it writes its auxiliary files in its CWD
+            self._call_latte(polynomial_file, polytope_file, output_file,
+                             folder, deadline)
+            # read back the result
+            result = self._read_output_file(output_file)
+        finally:
+            # remove the temporary folder and files
+            rmtree(folder, ignore_errors=True)
+
+        if self.cache is not None:
+            self.cache.put(key, result)
         return result
         
 
     def integrate(self, integrand, polytope, index=0):
         """Generates the input files and calls LattE's "integrate" executable
         to calculate the integral. Then, reads back the result and returns it
-        as a float.
+        as a float. If the cache is enabled and the same LattE input has
+        already been integrated, returns the cached result instead.
+
+        Integrals over axis-aligned boxes and polytopes with dimension up to
+        max_native_dimension are computed natively, unless disabled. If the
+        polytope is the product of polytopes over disjoint blocks of
+        variables, each monomial is integrated as a product of integrals over
+        the blocks, which are cached in memory, provided that the integrand
+        is a monomial or that all the blocks are integrated natively. Empty
+        and lower-dimensional polytopes are detected by linear programming
+        and their integral is 0, without calling LattE. The duplicate and
+        redundant inequalities are removed before calling LattE.
+
+        Keyword arguments:
+        integrand -- the polynomial
+        polytope -- the bounds of the integral
+
+        """
+        return self.integrate_with_info(integrand, polytope, index)[0]
+
+    def integrate_with_info(self, integrand, polytope, index=0,
+                            rel_error=None, deadline=None):
+        """Same as integrate, but returns also a dictionary counting how the
+        integral was computed, e.g. {"n_box" : 1}.
+
+        If rel_error is given, the integrals that can't be computed natively
+        are estimated by Monte Carlo sampling and the dictionary contains
+        the variance of the estimate, e.g. {"n_montecarlo" : 1,
+        "variance" : 0.01}. Polytopes too thin to be sampled are integrated
+        exactly.
+
+        If deadline is given and the integral can't be computed natively,
+        WMITimeoutException is raised when the time is over.
 
         Keyword arguments:
         integrand -- the polynomial
         polytope -- the bounds of the integral
+        rel_error -- target standard error of the approximate integrals,
+            relative to their value (optional)
+        deadline -- time (as returned by time.time) at which LattE and the
+            sampling are interrupted (optional)
 
         """
         assert(isinstance(integrand, Polynomial)
                and isinstance(polytope, Polytope)),\
                "Arguments should be of type Polynomial, Polytope."
-        # create a temporary folder containing the input and output files
-        # possibly removing an older one
-        folder = Integrator.FOLDER_TEMPLATE.format(index)
-        if isdir(folder):
-            rmtree(folder)
-            
-        makedirs(folder)        
-        polynomial_file = Integrator.POLYNOMIAL_TEMPLATE
-        polytope_file = Integrator.POLYTOPE_TEMPLATE
-        output_file = Integrator.OUTPUT_TEMPLATE        
-        # change the CWD and create the temporary files
-        original_cwd = getcwd()
-        chdir(folder)
+        info = {}
         # variable ordering is relevant in LattE files 
         variables = list(integrand.variables.union(polytope.variables))
         variables.sort()
-        self._write_polynomial_file(integrand, variables, polynomial_file)
-        self._write_polytope_file(polytope, variables, polytope_file)
-        # integrate and dump the result on file
-        self._call_latte(polynomial_file, polytope_file, output_file)
-        # read back the result and return to the original CWD
-        result = self._read_output_file(output_file)            
-        chdir(original_cwd)
-        # remove the temporary folder and files
-        rmtree(folder)        
-        return result
+        if self.factorize and integrand.variables <= polytope.variables:
+            blocks = polytope.split()
+            # each monomial is integrated over each block, which is worth it
+            # only if there is a single monomial or if no block needs LattE
+            if len(blocks) > 1 and (
+                    len(integrand.monomials) == 1 or
+                    all(self._is_native(integrand, block,
+                                        sorted(block.variables))
+                        for block in blocks)):
+                info["n_factorized"] = 1
+                return self._integrate_blocks(integrand, blocks, index,
+                                              rel_error, deadline, info)
+
+        if self.native and native.is_integrable(integrand):
+            bounds = native.box(polytope, variables)
+            if bounds is not None:
+                info["n_box"] = 1
+                return self._integrate_box(integrand, bounds), info
+            elif len(variables) == 2:
+                info["n_polygon"] = 1
+                return self._integrate_polygon(integrand, polytope,
+                                               variables), info
+            elif len(variables) <= self.max_native_dimension:
+                info["n_triangulated"] = 1
+                return self._integrate_triangulated(integrand, polytope,
+                                                    variables), info
+
+        if not is_full_dimensional(self._rows(polytope, variables),
+                                   len(variables)):
+            # measure-zero cell, LattE would fail
+            info["n_empty"] = 1
+            return 0.0, info
+
+        if deadline is not None and time() >= deadline:
+            raise WMITimeoutException()
+
+        if rel_error is not None:
+            result = montecarlo.integrate(integrand, polytope, variables,
+                                          rel_error, deadline=deadline)
+            # otherwise the polytope is unbounded or too thin to be sampled,
+            # it is integrated exactly
+            if result is not None:
+                info["n_montecarlo"] = 1
+                volume, info["variance"] = result
+                return volume, info
+
+        n_redundant = self._remove_redundant_bounds(polytope, variables)
+        if n_redundant > 0:
+            info["n_redundant_bounds"] = n_redundant
+        polynomial_repr = self._polynomial_repr(integrand, variables)
+        polytope_repr = self._polytope_repr(polytope, variables)
+        volume = self._integrate_latte_repr(polynomial_repr, polytope_repr,
+                                            index, info, deadline)
+        return volume, info
+
+    def bound(self, integrand, polytope, exact=True):
+        """Returns an upper bound on the absolute value of the integral,
+        computed from a box enclosing the polytope. The box is given by the
+        bounds on single variables if they enclose the polytope, otherwise
+        it is the bounding box computed by linear programming. The bound is
+        0 if the polytope is empty and infinite if it is unbounded or the
+        polynomial has negative or fractional exponents.
+
+        Keyword arguments:
+        integrand -- the polynomial
+        polytope -- the bounds of the integral
+        exact -- if False, no LP is solved and the bound is infinite when the
+                 bounds on single variables don't enclose the polytope
+                 (default: True)
+
+        """
+        if not native.is_integrable(integrand):
+            return float("inf")
+        variables = list(integrand.variables.union(polytope.variables))
+        rows = self._rows(polytope, variables)
+        status, lower, upper = self._outer_box(rows, len(variables))
+        if status is None:
+            if not exact:
+                return float("inf")
+            status, lower, upper = bounding_box(rows, len(variables))
+        if status == LP_INFEASIBLE:
+            return 0.0
+        elif status != LP_OPTIMAL:
+            return float("inf")
+        bounds = {var : (lower[i], upper[i])
+                  for i, var in enumerate(variables)}
+        return float(native.bound_box(integrand, bounds))
+
+    @staticmethod
+    def _outer_box(rows, n):
+        # box given by the rows on a single variable, in the same format as
+        # bounding_box, the status is None if some variable isn't bounded
+        lower, upper = single_variable_bounds(rows, n)
+        if any(l is None for l in lower) or any(u is None for u in upper):
+            return None, None, None
+        if any(l > u for l, u in zip(lower, upper)):
+            return LP_INFEASIBLE, None, None
+        return LP_OPTIMAL, lower, upper
+
+    def _remove_redundant_bounds(self, polytope, variables):
+        """Removes the duplicate bounds of the polytope and the ones implied
+        by the others, in place. Returns the number of bounds removed.
+
+        """
+        n_removed = polytope.reduce()
+        rows = self._rows(polytope, variables)
+        # the bounds implied by the bounds on single variables are always
+        # removed, solving an LP for each bound is worth it only for polytopes
+        # with many bounds
+        exact = (self.remove_redundant and
+                 len(rows) > Integrator.REDUNDANCY_RATIO * len(variables))
+        redundant = set(redundant_rows(rows, exact))
+        polytope.polytope = [bound for i, bound in enumerate(polytope.polytope)
+                             if not i in redundant]
+        return n_removed + len(redundant)
+
+    @staticmethod
+    def _rows(polytope, variables):
+        # list of (coefficients, constant), encoding coefficients * x <= constant
+        return [(tuple(bound.coefficients.get(var, 0) for var in variables),
+                 bound.constant) for bound in polytope.polytope]
+
+    def _is_native(self, integrand, polytope, variables):
+        # True iff the integral is computed natively, see integrate_with_info
+        return (self.native and native.is_integrable(integrand) and
+                (len(variables) <= max(2, self.max_native_dimension) or
+                 native.box(polytope, variables) is not None))
+
+    def _integrate_blocks(self, integrand, blocks, index, rel_error, deadline,
+                          info):
+        """Integrates each monomial as the product of its integrals over the
+        blocks, merging the statistics of the integrations in info.
+
+        """
+        block_keys = [block.key() for block in blocks]
+        terms = []
+        # standard error of the result, accumulated over the monomials
+        stderr = 0.0
+        for coefficient, factors in integrand.split([block.variables
+                                                     for block in blocks]):
+            term = float(coefficient)
+            relative_variance = 0.0
+            for factor, block, block_key in zip(factors, blocks, block_keys):
+                key = (block_key, factor.key(), rel_error)
+                hit, result = self.block_cache.get(key)
+                if hit:
+                    info["n_block_cache_hits"] = (
+                        info.get("n_block_cache_hits", 0) + 1)
+                else:
+                    volume, block_info = self.integrate_with_info(
+                        factor, block, index, rel_error, deadline)
+                    result = (volume, block_info.pop("variance", 0.0))
+                    for name, value in block_info.iteritems():
+                        info[name] = info.get(name, 0) + value
+                    self.block_cache.put(key, result)
+
+                volume, variance = result
+                if volume is None:
+                    # unbounded, LattE would fail as well
+                    return None, info
+                term *= volume
+                if volume != 0:
+                    relative_variance += variance / volume ** 2
+            terms.append(term)
+            stderr += abs(term) * sqrt(relative_variance)
+
+        if rel_error is not None:
+            info["variance"] = stderr ** 2
+        return sum(terms), info
+
+    def _integrate_box(self, integrand, bounds):
+        for lower, upper in bounds.itervalues():
+            if lower is None or upper is None:
+                # unbounded, LattE would fail as well
+                return None
+        return float(native.integrate_box(integrand, bounds))
+
+    def _integrate_polygon(self, integrand, polytope, variables):
+        vertices = native.polygon_vertices(polytope, variables)
+        if vertices is None:
+            # unbounded, LattE would fail as well
+            return None
+        return float(native.integrate_polygon(integrand, variables, vertices))
+
+    def _integrate_triangulated(self, integrand, polytope, variables):
+        enumeration = native.polytope_vertices(polytope, variables)
+        if enumeration is None:
+            # unbounded, LattE would fail as well
+            return None
+        vertices, tight = enumeration
+        return float(native.integrate_polytope(integrand, variables, vertices,
+                                               tight))
 
     def _read_output_file(self, path):
         with open(path, 'r') as f:
@@ -125,6 +440,10 @@ class Integrator(Loggable):
         return None                                
         
     def _write_polynomial_file(self, integrand, variables, path):
+        with open(path,'w') as f:
+            f.write(self._polynomial_repr(integrand, variables))
+
+    def _polynomial_repr(self, integrand, variables):
         monomials_repr = []
         for monomial in integrand.monomials:
             monomial_repr = "[" + str(monomial.coefficient) + ",["
@@ -136,11 +455,13 @@ class Integrator(Loggable):
                     exponents.append("0")
             monomial_repr += ",".join(exponents) + "]]"
             monomials_repr.append(monomial_repr)
-        latte_repr = "[" + ",".join(monomials_repr) + "]"
-        with open(path,'w') as f:
-            f.write(latte_repr)
+        return "[" + ",".join(monomials_repr) + "]"
 
     def _write_polytope_file(self, polytope, variables, path):
+        with open(path,'w') as f:
+            f.write(self._polytope_repr(polytope, variables))
+
+    def _polytope_repr(self, polytope, variables):
         n_ineq = str(len(polytope.polytope))
         n_vars = str(len(variables) + 1)
         latte_repr = "{} {}\n".format(n_ineq, n_vars)
@@ -153,15 +474,27 @@ class Integrator(Loggable):
                     latte_repr += "0 "
             latte_repr += "\n"
 
-        with open(path,'w') as f:
-            f.write(latte_repr)       
+        return latte_repr
 
-    def _call_latte(self, polynomial_file, polytope_file, output_file):
+    def _call_latte(self, polynomial_file, polytope_file, output_file,
+                    cwd=None, deadline=None):
         with open(output_file,'w') as f:
-            return_value = call(["integrate",
-                                 "--valuation=integrate", self.algorithm,
-                                 "--monomials=" + polynomial_file,
-                                 polytope_file], stdout=f, stderr=f)
+            task = Popen(["integrate",
+                          "--valuation=integrate", self.algorithm,
+                          "--monomials=" + polynomial_file,
+                          polytope_file], stdout=f, stderr=f, cwd=cwd)
+            if deadline is None:
+                return_value = task.wait()
+            else:
+                # polling every POLL_DELTA seconds
+                while task.poll() is None:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        task.kill()
+                        task.wait()
+                        raise WMITimeoutException()
+                    sleep(min(Integrator.POLL_DELTA, remaining))
+                return_value = task.returncode
             if return_value != 0:
                 msg = "LattE returned with status {}"
                 # LattE returns an exit status != 0 if the polytope is empty.
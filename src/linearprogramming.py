@@ -0,0 +1,277 @@
+"""This module implements an exact linear programming solver over the
+rationals, used to reason about the polytopes before integrating them
+(e.g. bounding boxes, emptiness and redundancy of the inequalities).
+
+The solver is the two-phase simplex method with Bland's rule, hence it
+always terminates. It is meant for the small problems arising from the
+cells of WMI, not for large scale optimization.
+
+"""
+
+__version__ = '0.999'
+__author__ = 'Paolo Morettin'
+
+from fractions import Fraction
+
+LP_OPTIMAL = "optimal"
+LP_INFEASIBLE = "infeasible"
+LP_UNBOUNDED = "unbounded"
+
+
+def maximize(objective, rows):
+    """Solves max objective * x subject to a * x <= b for each (a, b) in rows,
+    where x is a vector of free variables.
+
+    Returns a tuple (status, value, point), where status is one of
+    LP_OPTIMAL, LP_INFEASIBLE, LP_UNBOUNDED and value, point are the optimal
+    value and solution (None if the status is not LP_OPTIMAL).
+
+    Keyword arguments:
+    objective -- list of coefficients of the objective function
+    rows -- list of pairs (coefficients, constant)
+
+    """
+    n = len(objective)
+    m = len(rows)
+    # columns: x+ (n), x- (n), slacks (m), artificials (one per row with b<0)
+    negative = [i for i, (_, b) in enumerate(rows) if b < 0]
+    n_cols = 2 * n + m + len(negative)
+    tableau = []
+    basis = []
+    for i, (coefficients, b) in enumerate(rows):
+        row = [Fraction(0)] * (n_cols + 1)
+        sign = -1 if b < 0 else 1
+        for j in xrange(n):
+            row[j] = sign * Fraction(coefficients[j])
+            row[n + j] = -row[j]
+        row[2 * n + i] = Fraction(sign)
+        row[n_cols] = sign * Fraction(b)
+        if b < 0:
+            artificial = 2 * n + m + negative.index(i)
+            row[artificial] = Fraction(1)
+            basis.append(artificial)
+        else:
+            basis.append(2 * n + i)
+        tableau.append(row)
+
+    if len(negative) > 0:
+        # phase 1: maximize -sum(artificials)
+        phase1 = [0] * (2 * n + m) + [-1] * len(negative)
+        _simplex(tableau, basis, phase1)
+        if sum(tableau[i][n_cols] for i, b in enumerate(basis)
+               if b >= 2 * n + m) > 0:
+            return LP_INFEASIBLE, None, None
+        _remove_artificials(tableau, basis, 2 * n + m)
+        n_cols = 2 * n + m
+        tableau = [row[:n_cols] + [row[-1]] for row in tableau]
+
+    phase2 = ([Fraction(c) for c in objective] +
+              [-Fraction(c) for c in objective] + [0] * m)
+    if not _simplex(tableau, basis, phase2):
+        return LP_UNBOUNDED, None, None
+
+    values = [Fraction(0)] * n_cols
+    for i, b in enumerate(basis):
+        values[b] = tableau[i][n_cols]
+    point = tuple(values[j] - values[n + j] for j in xrange(n))
+    value = sum(Fraction(c) * x for c, x in zip(objective, point))
+    return LP_OPTIMAL, value, point
+
+def minimize(objective, rows):
+    """Same as maximize, but minimizes the objective function."""
+    status, value, point = maximize([-c for c in objective], rows)
+    if status == LP_OPTIMAL:
+        value = -value
+    return status, value, point
+
+def bounding_box(rows, n):
+    """Returns a tuple (status, lower, upper), where lower and upper are the
+    lists of the exact bounds of {x | a * x <= b for each (a, b) in rows} on
+    each of the n variables. The lists are None if the status is not
+    LP_OPTIMAL, i.e. if the set is empty or unbounded.
+
+    Keyword arguments:
+    rows -- list of pairs (coefficients, constant)
+    n -- the number of variables
+
+    """
+    status, _, _ = maximize([0] * n, rows)
+    if status != LP_OPTIMAL:
+        return status, None, None
+    lower, upper = [], []
+    for i in xrange(n):
+        direction = [0] * n
+        direction[i] = 1
+        status, value, _ = minimize(direction, rows)
+        if status != LP_OPTIMAL:
+            return status, None, None
+        lower.append(value)
+        status, value, _ = maximize(direction, rows)
+        if status != LP_OPTIMAL:
+            return status, None, None
+        upper.append(value)
+    return LP_OPTIMAL, lower, upper
+
+def is_full_dimensional(rows, n):
+    """Returns True iff {x | a * x <= b for each (a, b) in rows} has a
+    non-empty interior, i.e. it is neither empty nor lower-dimensional.
+
+    The check maximizes t subject to a * x + t <= b, with t <= 1: the
+    interior is non-empty iff the optimum is positive.
+
+    Keyword arguments:
+    rows -- list of pairs (coefficients, constant)
+    n -- the number of variables
+
+    """
+    slack_rows = [(tuple(coefficients) + (1,), constant)
+                  for coefficients, constant in rows]
+    slack_rows.append(((0,) * n + (1,), 1))
+    status, value, _ = maximize((0,) * n + (1,), slack_rows)
+    return status == LP_OPTIMAL and value > 0
+
+def redundant_rows(rows, exact=True):
+    """Returns the sorted list of indices of the rows that can be removed
+    without changing the set {x | a * x <= b for each (a, b) in rows}, since
+    each one is implied by the rows that are kept.
+
+    The rows implied by the box given by the rows on a single variable are
+    found without solving any LP. If exact is True, each one of the other
+    rows is checked by solving an LP, otherwise it is kept.
+
+    Keyword arguments:
+    rows -- list of pairs (coefficients, constant)
+    exact -- if True, all the redundant rows are found (default: True)
+
+    """
+    implied = set(_box_implied_rows(rows))
+    kept = [i for i in xrange(len(rows)) if not i in implied]
+    if not exact:
+        return sorted(implied)
+    redundant = []
+    for i in list(kept):
+        coefficients, constant = rows[i]
+        others = [rows[j] for j in kept if j != i]
+        status, value, _ = maximize(coefficients, others)
+        if status == LP_OPTIMAL and value <= constant:
+            kept.remove(i)
+            redundant.append(i)
+    return sorted(implied.union(redundant))
+
+def single_variable_bounds(rows, n):
+    """Returns the lists (lower, upper) of the tightest bounds on each of
+    the n variables given by the rows on a single variable, None where
+    there is no such bound. No LP is solved, the box they define encloses
+    {x | a * x <= b for each (a, b) in rows}.
+
+    Keyword arguments:
+    rows -- list of pairs (coefficients, constant)
+    n -- the number of variables
+
+    """
+    lower = [None] * n
+    upper = [None] * n
+    for coefficients, constant in rows:
+        nonzero = [j for j in xrange(n) if coefficients[j] != 0]
+        if len(nonzero) != 1:
+            continue
+        j = nonzero[0]
+        value = Fraction(constant) / coefficients[j]
+        if coefficients[j] > 0:
+            if upper[j] is None or value < upper[j]:
+                upper[j] = value
+        elif lower[j] is None or value > lower[j]:
+            lower[j] = value
+    return lower, upper
+
+def _box_implied_rows(rows):
+    # indices of the rows on several variables whose maximum over the box
+    # given by the rows on a single variable is within their constant
+    if len(rows) == 0:
+        return []
+    n = len(rows[0][0])
+    lower, upper = single_variable_bounds(rows, n)
+    implied = []
+    for i, (coefficients, constant) in enumerate(rows):
+        nonzero = [j for j in xrange(n) if coefficients[j] != 0]
+        if len(nonzero) < 2:
+            continue
+        extremes = [upper[j] if coefficients[j] > 0 else lower[j]
+                    for j in nonzero]
+        if any(x is None for x in extremes):
+            continue
+        if sum(coefficients[j] * x
+               for j, x in zip(nonzero, extremes)) <= constant:
+            implied.append(i)
+    return implied
+
+def _simplex(tableau, basis, objective):
+    # returns False iff the problem is unbounded. The number of columns is
+    # given by the objective, the tableau may have no rows
+    n_cols = len(objective)
+    # objective row of the reduced costs, which are 0 on the basis, updated
+    # by each pivot
+    reduced = [Fraction(c) for c in objective] + [Fraction(0)]
+    for i, b in enumerate(basis):
+        factor = reduced[b]
+        if factor != 0:
+            row = tableau[i]
+            for k in xrange(n_cols + 1):
+                if row[k] != 0:
+                    reduced[k] -= factor * row[k]
+    while True:
+        # Bland's rule: the entering variable has the smallest index
+        entering = None
+        for j in xrange(n_cols):
+            if reduced[j] > 0:
+                entering = j
+                break
+        if entering is None:
+            return True
+
+        leaving = None
+        for i, row in enumerate(tableau):
+            if row[entering] > 0:
+                ratio = row[n_cols] / row[entering]
+                if leaving is None or ratio < best or \
+                   (ratio == best and basis[i] < basis[leaving]):
+                    leaving, best = i, ratio
+        if leaving is None:
+            return False
+        _pivot(tableau, basis, leaving, entering)
+        pivot_row = tableau[leaving]
+        factor = reduced[entering]
+        for k in xrange(n_cols + 1):
+            if pivot_row[k] != 0:
+                reduced[k] -= factor * pivot_row[k]
+
+def _pivot(tableau, basis, row_index, col):
+    pivot_row = tableau[row_index]
+    pivot = pivot_row[col]
+    for k in xrange(len(pivot_row)):
+        pivot_row[k] /= pivot
+    for i, row in enumerate(tableau):
+        if i != row_index and row[col] != 0:
+            factor = row[col]
+            for k in xrange(len(row)):
+                if pivot_row[k] != 0:
+                    row[k] -= factor * pivot_row[k]
+    basis[row_index] = col
+
+def _remove_artificials(tableau, basis, first_artificial):
+    # pivots the (zero-valued) artificials out of the basis, removing the
+    # redundant rows
+    i = 0
+    while i < len(basis):
+        if basis[i] >= first_artificial:
+            col = None
+            for j in xrange(first_artificial):
+                if tableau[i][j] != 0 and not j in basis:
+                    col = j
+                    break
+            if col is None:
+                del tableau[i]
+                del basis[i]
+                continue
+            _pivot(tableau, basis, i, col)
+        i += 1
@@ -0,0 +1,134 @@
+"""This module implements the approximate integration of polynomials over
+(convex) polytopes by Monte Carlo sampling.
+
+The polytope is enclosed in its bounding box, computed exactly by linear
+programming. Then, batches of points are sampled uniformly in the box and
+the polynomial is evaluated on the whole batch with NumPy, discarding the
+points outside the polytope (rejection sampling). Sampling stops when the
+standard error of the estimate falls below the requested relative error,
+provided that enough points fell in the polytope for the error itself to
+be reliable. Thin polytopes, occupying a tiny fraction of their bounding
+box (e.g. simplices in high dimension), are not estimated: the caller is
+expected to integrate them exactly.
+
+"""
+
+__version__ = '0.999'
+__author__ = 'Paolo Morettin'
+
+from time import time
+
+import numpy as np
+
+from linearprogramming import bounding_box, LP_INFEASIBLE, LP_OPTIMAL
+from wmiexception import WMITimeoutException
+
+# number of points sampled at each iteration
+DEF_BATCH_SIZE = 10000
+# maximum number of points sampled for a single integral
+DEF_MAX_SAMPLES = 1000000
+# minimum number of points in the polytope for the estimate to be returned
+DEF_MIN_ACCEPTED = 1000
+
+
+def integrate(integrand, polytope, variables, rel_error, batch_size=None,
+              max_samples=None, min_accepted=None, seed=None,
+              deadline=None):
+    """Estimates the integral of the polynomial over the polytope. Returns
+    the pair (estimate, variance), the variance of the estimate being the
+    square of its standard error, or None if the polytope is unbounded or
+    if less than min_accepted of the max_samples points fell in it.
+    Raises WMITimeoutException if the deadline expires while sampling.
+
+    Keyword arguments:
+    integrand -- Polynomial instance
+    polytope -- Polytope instance
+    variables -- the variable names
+    rel_error -- target standard error, relative to the estimate
+    batch_size -- number of points sampled at each iteration (optional)
+    max_samples -- maximum number of points sampled (optional)
+    min_accepted -- minimum number of points in the polytope (optional)
+    seed -- seed of the random number generator (optional)
+    deadline -- time (as returned by time.time) at which the sampling is
+        interrupted (optional)
+
+    """
+    batch_size = batch_size or DEF_BATCH_SIZE
+    max_samples = max_samples or DEF_MAX_SAMPLES
+    min_accepted = min_accepted or DEF_MIN_ACCEPTED
+    rows = [(tuple(bound.coefficients.get(var, 0) for var in variables),
+             bound.constant) for bound in polytope.polytope]
+    status, lower, upper = bounding_box(rows, len(variables))
+    if status == LP_INFEASIBLE:
+        return 0.0, 0.0
+    elif status != LP_OPTIMAL:
+        return None
+    lower = np.array(map(float, lower))
+    upper = np.array(map(float, upper))
+    box_volume = float(np.prod(upper - lower))
+    if box_volume == 0:
+        # lower-dimensional polytope
+        return 0.0, 0.0
+
+    matrix = np.array([[float(bound.coefficients.get(var, 0))
+                        for var in variables]
+                       for bound in polytope.polytope]).reshape(
+                           (-1, len(variables)))
+    constants = np.array([float(bound.constant)
+                          for bound in polytope.polytope])
+    coefficients = np.array([float(monomial.coefficient)
+                             for monomial in integrand.monomials])
+    exponents = np.array([[float(monomial.exponents.get(var, 0))
+                           for var in variables]
+                          for monomial in integrand.monomials]).reshape(
+                              (-1, len(variables)))
+
+    generator = np.random.RandomState(seed)
+    n_samples = 0
+    n_accepted = 0
+    total = 0.0
+    total_squares = 0.0
+    while n_samples < max_samples:
+        if deadline is not None and time() >= deadline:
+            raise WMITimeoutException()
+        points = lower + (upper - lower) * generator.random_sample(
+            (batch_size, len(variables)))
+        inside = np.all(points.dot(matrix.T) <= constants, axis=1)
+        values = evaluate(coefficients, exponents, points[inside])
+        total += values.sum()
+        total_squares += (values ** 2).sum()
+        n_samples += batch_size
+        n_accepted += int(inside.sum())
+
+        if n_accepted < min_accepted:
+            # give up if the acceptance rate is too low to reach
+            # min_accepted within max_samples
+            if n_accepted * max_samples < min_accepted * n_samples:
+                return None
+            continue
+
+        mean = total / n_samples
+        variance = (total_squares / n_samples - mean ** 2) / (n_samples - 1)
+        estimate = box_volume * mean
+        variance = max(variance, 0.0) * box_volume ** 2
+        if variance <= (rel_error * estimate) ** 2:
+            return estimate, variance
+
+    if n_accepted < min_accepted:
+        return None
+    return estimate, variance
+
+def evaluate(coefficients, exponents, points):
+    """Evaluates a polynomial on a batch of points, returning the array of
+    values.
+
+    Keyword arguments:
+    coefficients -- array of the coefficients of the monomials
+    exponents -- matrix of the exponents, a row for each monomial
+    points -- matrix of the points, a row for each point
+
+    """
+    if len(coefficients) == 0:
+        return np.zeros(len(points))
+    powers = np.power(points[:, np.newaxis, :], exponents[np.newaxis, :, :])
+    return np.prod(powers, axis=2).dot(coefficients)
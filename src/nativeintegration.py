@@ -0,0 +1,504 @@
+"""This module implements the exact, in-process integration of polynomials
+over simple polytopes, avoiding the overhead of calling LattE.
+
+All the computations are performed with Fraction arithmetic, hence the
+results are exact.
+
+"""
+
+__version__ = '0.999'
+__author__ = 'Paolo Morettin'
+
+from fractions import Fraction
+from itertools import combinations
+from math import factorial
+
+
+def integrate_univariate(coefficients, rng):
+    """Returns the exact integral of a univariate polynomial over an interval.
+
+    Keyword arguments:
+    coefficients -- list of coefficients, in decreasing order of degree
+    rng -- pair (lower, upper) encoding the interval
+
+    """
+    lower, upper = Fraction(rng[0]), Fraction(rng[1])
+    degree = len(coefficients) - 1
+    result = Fraction(0)
+    for i, coefficient in enumerate(coefficients):
+        result += Fraction(coefficient) * power_integral(degree - i, lower, upper)
+    return result
+
+def integrate_univariate_batch(coefficients_list, ranges):
+    """Returns the list of the exact integrals of many univariate polynomials,
+    each one over its interval.
+
+    Keyword arguments:
+    coefficients_list -- list of lists of coefficients, in decreasing order of
+        degree
+    ranges -- list of pairs (lower, upper) encoding the intervals
+
+    """
+    assert(len(coefficients_list) == len(ranges)),\
+        "The number of polynomials and intervals should be the same"
+    return [integrate_univariate(coefficients, rng)
+            for coefficients, rng in zip(coefficients_list, ranges)]
+
+def power_integral(exponent, lower, upper):
+    """Returns the integral of x^exponent over [lower, upper]."""
+    exponent = int(exponent)
+    return (upper**(exponent + 1) - lower**(exponent + 1)) / (exponent + 1)
+
+def is_integrable(integrand):
+    """Returns True iff all the exponents of the polynomial are non-negative
+    integers, so that it can be integrated natively.
+
+    """
+    for monomial in integrand.monomials:
+        for exponent in monomial.exponents.itervalues():
+            if exponent < 0 or Fraction(exponent).denominator != 1:
+                return False
+    return True
+
+def box(polytope, variables):
+    """If all the inequalities of the polytope are univariate, returns a dict
+    {var : (lower, upper)} with the bounds on each variable, otherwise
+    returns None. Missing bounds are None.
+
+    Keyword arguments:
+    polytope -- Polytope instance
+    variables -- the variable names
+
+    """
+    bounds = {var : [None, None] for var in variables}
+    for bound in polytope.polytope:
+        nonzero = [(var, c) for var, c in bound.coefficients.iteritems()
+                   if c != 0]
+        if len(nonzero) != 1:
+            return None
+        var, coefficient = nonzero[0]
+        # coefficient * var <= constant
+        value = Fraction(bound.constant, coefficient)
+        lower, upper = bounds[var]
+        if coefficient > 0:
+            bounds[var][1] = value if upper is None else min(upper, value)
+        else:
+            bounds[var][0] = value if lower is None else max(lower, value)
+    return {var : tuple(rng) for var, rng in bounds.iteritems()}
+
+def integrate_box(integrand, bounds):
+    """Returns the exact integral of a Polynomial over an axis-aligned box,
+    computed as a sum of products of univariate integrals. Empty boxes have
+    integral 0.
+
+    Keyword arguments:
+    integrand -- Polynomial instance
+    bounds -- dict {var : (lower, upper)} containing all the variables of
+        the integrand
+
+    """
+    for lower, upper in bounds.itervalues():
+        if lower >= upper:
+            return Fraction(0)
+
+    # univariate integrals are shared among the monomials
+    integrals = {}
+    result = Fraction(0)
+    for monomial in integrand.monomials:
+        term = monomial.coefficient
+        for var, (lower, upper) in bounds.iteritems():
+            exponent = monomial.exponents.get(var, 0)
+            if not (var, exponent) in integrals:
+                integrals[(var, exponent)] = power_integral(exponent, lower,
+                                                            upper)
+            term *= integrals[(var, exponent)]
+        result += term
+    return result
+
+def bound_box(integrand, bounds):
+    """Returns an upper bound on the absolute value of the integral of a
+    Polynomial over any subset of an axis-aligned box: the volume of the box
+    times the maximum absolute value that each monomial can take in it.
+
+    Keyword arguments:
+    integrand -- Polynomial instance, with non-negative integer exponents
+    bounds -- dict {var : (lower, upper)} containing all the variables of
+        the integrand
+
+    """
+    volume = Fraction(1)
+    for lower, upper in bounds.itervalues():
+        if lower >= upper:
+            return Fraction(0)
+        volume *= upper - lower
+
+    maximum = Fraction(0)
+    for monomial in integrand.monomials:
+        term = abs(monomial.coefficient)
+        for var, (lower, upper) in bounds.iteritems():
+            term *= max(abs(lower), abs(upper)) ** int(
+                monomial.exponents.get(var, 0))
+        maximum += term
+    return volume * maximum
+
+def polygon_vertices(polytope, variables):
+    """Returns the vertices of a bounded 2-dimensional polytope in
+    counterclockwise order, or None if the polytope is unbounded. Empty or
+    degenerate polytopes have less than 3 vertices.
+
+    Keyword arguments:
+    polytope -- Polytope instance
+    variables -- the two variable names
+
+    """
+    assert(len(variables) == 2), "The polytope should be 2-dimensional"
+    rows = _rows(polytope, variables)
+    if not _is_bounded_2d(rows):
+        return None
+
+    vertices = set()
+    for i in xrange(len(rows)):
+        (a1, b1), c1 = rows[i]
+        for j in xrange(i + 1, len(rows)):
+            (a2, b2), c2 = rows[j]
+            det = a1 * b2 - a2 * b1
+            if det == 0:
+                # parallel lines
+                continue
+            point = (Fraction(c1 * b2 - c2 * b1, det),
+                     Fraction(a1 * c2 - a2 * c1, det))
+            if _satisfies(rows, point):
+                vertices.add(point)
+
+    vertices = list(vertices)
+    if len(vertices) < 3:
+        return vertices
+
+    # sort the vertices by angle around their centroid
+    cx = sum(v[0] for v in vertices) / len(vertices)
+    cy = sum(v[1] for v in vertices) / len(vertices)
+    def half(v):
+        dx, dy = v[0] - cx, v[1] - cy
+        return 0 if (dy > 0 or (dy == 0 and dx > 0)) else 1
+    def compare(v, w):
+        if half(v) != half(w):
+            return half(v) - half(w)
+        cross = (v[0] - cx) * (w[1] - cy) - (v[1] - cy) * (w[0] - cx)
+        return -1 if cross > 0 else (1 if cross < 0 else 0)
+    vertices.sort(cmp=compare)
+    return vertices
+
+def integrate_polygon(integrand, variables, vertices):
+    """Returns the exact integral of a Polynomial over a convex polygon, given
+    its vertices in counterclockwise order, by triangulating it.
+
+    Keyword arguments:
+    integrand -- Polynomial instance
+    variables -- the two variable names
+    vertices -- list of vertices (pairs of Fractions)
+
+    """
+    if len(vertices) < 3:
+        return Fraction(0)
+    polynomial = to_dict(integrand, variables)
+    result = Fraction(0)
+    # fan triangulation from the first vertex
+    for i in xrange(1, len(vertices) - 1):
+        simplex = [vertices[0], vertices[i], vertices[i + 1]]
+        result += integrate_simplex(polynomial, simplex)
+    return result
+
+def to_dict(integrand, variables):
+    """Converts a Polynomial into a dict {exponents : coefficient}, where
+    exponents is the tuple of (integer) exponents of the variables.
+
+    """
+    polynomial = {}
+    for monomial in integrand.monomials:
+        exponents = tuple(int(monomial.exponents.get(var, 0))
+                          for var in variables)
+        polynomial[exponents] = (polynomial.get(exponents, 0) +
+                                 monomial.coefficient)
+    return polynomial
+
+def polytope_vertices(polytope, variables):
+    """Returns the pair (vertices, tight), where vertices is the list of the
+    vertices of a bounded polytope and tight[i] is the set of indices of the
+    rows of the polytope that are tight on vertices[i]. Returns None if the
+    polytope is unbounded.
+
+    The vertices are the feasible solutions of the d x d non-singular
+    subsystems of the rows, the enumeration is exponential in d.
+
+    Keyword arguments:
+    polytope -- Polytope instance
+    variables -- the variable names
+
+    """
+    rows = _rows(polytope, variables)
+    d = len(variables)
+    vertices = {}
+    for subset in combinations(xrange(len(rows)), d):
+        point = _solve([rows[i][0] for i in subset],
+                       [rows[i][1] for i in subset])
+        if point is not None and not point in vertices and \
+           _satisfies(rows, point):
+            vertices[point] = set(i for i, (coefficients, constant)
+                                  in enumerate(rows)
+                                  if sum(a * x for a, x in zip(coefficients,
+                                                               point))
+                                  == constant)
+
+    if len(vertices) == 0:
+        if _rank([coefficients for coefficients, _ in rows]) < d:
+            # empty or containing a line, LattE would fail as well
+            return None
+        # pointed and without vertices, hence empty
+        return [], []
+
+    if not _is_bounded(rows, d):
+        return None
+    points = list(vertices)
+    return points, [vertices[point] for point in points]
+
+def triangulate(vertices, tight, d):
+    """Returns a triangulation of a full-dimensional polytope as a list of
+    simplices (lists of d + 1 vertices), without adding new vertices.
+
+    The pulling triangulation is used: the first vertex of each face is
+    joined to the triangulations of the facets not containing it.
+
+    Keyword arguments:
+    vertices -- list of vertices
+    tight -- list of sets of tight rows, as returned by polytope_vertices
+    d -- dimension of the polytope
+
+    """
+    if _affine_dimension(vertices) < d:
+        return []
+
+    def pull(face, dimension):
+        if dimension == 0:
+            return [[face[0]]]
+        apex = face[0]
+        common = set.intersection(*[tight[v] for v in face])
+        facets = set()
+        for row in set.union(*[tight[v] for v in face]) - common:
+            facet = tuple(v for v in face if row in tight[v])
+            if not apex in facet and not facet in facets and \
+               _affine_dimension([vertices[v] for v in facet]) == dimension - 1:
+                facets.add(facet)
+        simplices = []
+        for facet in facets:
+            for simplex in pull(facet, dimension - 1):
+                simplices.append([apex] + simplex)
+        return simplices
+
+    return [[vertices[v] for v in simplex]
+            for simplex in pull(tuple(xrange(len(vertices))), d)]
+
+def integrate_polytope(integrand, variables, vertices, tight):
+    """Returns the exact integral of a Polynomial over a bounded polytope, by
+    triangulating it and integrating over each simplex. The moments of the
+    standard simplex are shared among monomials and simplices.
+
+    Keyword arguments:
+    integrand -- Polynomial instance
+    variables -- the variable names
+    vertices -- list of vertices
+    tight -- list of sets of tight rows, as returned by polytope_vertices
+
+    """
+    polynomial = to_dict(integrand, variables)
+    moments = {}
+    result = Fraction(0)
+    for simplex in triangulate(vertices, tight, len(variables)):
+        result += integrate_simplex(polynomial, simplex, moments)
+    return result
+
+def integrate_simplex(polynomial, simplex, moments=None):
+    """Returns the exact integral of a polynomial over a simplex.
+
+    The polynomial is rewritten in the coordinates y of the standard simplex,
+    x = v_0 + sum_j y_j (v_j - v_0), whose monomials have integral
+    prod_j(b_j!) / (|b| + d)!.
+
+    Keyword arguments:
+    polynomial -- dict {exponents : coefficient}
+    simplex -- list of the d + 1 vertices of the d-dimensional simplex
+    moments -- dict caching the moments of the standard simplex (optional)
+
+    """
+    d = len(simplex) - 1
+    origin = simplex[0]
+    edges = [[simplex[j + 1][i] - origin[i] for j in xrange(d)]
+             for i in xrange(d)]
+    jacobian = abs(_determinant(edges))
+    if jacobian == 0:
+        return Fraction(0)
+
+    # x_i as a linear polynomial in y, its powers are shared by the monomials
+    linear = []
+    for i in xrange(d):
+        poly = {(0,) * d : Fraction(origin[i])}
+        for j in xrange(d):
+            if edges[i][j] != 0:
+                exponents = tuple(1 if k == j else 0 for k in xrange(d))
+                poly[exponents] = Fraction(edges[i][j])
+        linear.append(poly)
+    powers = [[{(0,) * d : Fraction(1)}] for _ in xrange(d)]
+
+    moments = {} if moments is None else moments
+    result = Fraction(0)
+    for exponents, coefficient in polynomial.iteritems():
+        term = {(0,) * d : coefficient}
+        for i, exponent in enumerate(exponents):
+            while len(powers[i]) <= exponent:
+                powers[i].append(_multiply(powers[i][-1], linear[i]))
+            term = _multiply(term, powers[i][exponent])
+        for beta, c in term.iteritems():
+            if not beta in moments:
+                moments[beta] = _standard_simplex_moment(beta)
+            result += c * moments[beta]
+
+    return result * jacobian
+
+def _standard_simplex_moment(beta):
+    numerator = 1
+    for b in beta:
+        numerator *= factorial(b)
+    return Fraction(numerator, factorial(sum(beta) + len(beta)))
+
+def _multiply(p, q):
+    result = {}
+    for e1, c1 in p.iteritems():
+        for e2, c2 in q.iteritems():
+            exponents = tuple(a + b for a, b in zip(e1, e2))
+            result[exponents] = result.get(exponents, 0) + c1 * c2
+    return result
+
+def _determinant(matrix):
+    # Gaussian elimination over the rationals
+    m = [[Fraction(x) for x in row] for row in matrix]
+    n = len(m)
+    det = Fraction(1)
+    for col in xrange(n):
+        pivot = None
+        for row in xrange(col, n):
+            if m[row][col] != 0:
+                pivot = row
+                break
+        if pivot is None:
+            return Fraction(0)
+        if pivot != col:
+            m[col], m[pivot] = m[pivot], m[col]
+            det = -det
+        det *= m[col][col]
+        for row in xrange(col + 1, n):
+            factor = m[row][col] / m[col][col]
+            if factor != 0:
+                for k in xrange(col, n):
+                    m[row][k] -= factor * m[col][k]
+    return det
+
+def _solve(matrix, rhs):
+    # returns the unique solution of matrix * x = rhs, or None
+    n = len(matrix)
+    m = [[Fraction(x) for x in row] + [Fraction(b)]
+         for row, b in zip(matrix, rhs)]
+    for col in xrange(n):
+        pivot = None
+        for row in xrange(col, n):
+            if m[row][col] != 0:
+                pivot = row
+                break
+        if pivot is None:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for row in xrange(n):
+            if row != col and m[row][col] != 0:
+                factor = m[row][col] / m[col][col]
+                for k in xrange(col, n + 1):
+                    m[row][k] -= factor * m[col][k]
+    return tuple(m[i][n] / m[i][i] for i in xrange(n))
+
+def _rank(matrix):
+    m = [[Fraction(x) for x in row] for row in matrix]
+    rank = 0
+    n_cols = len(m[0]) if len(m) > 0 else 0
+    for col in xrange(n_cols):
+        pivot = None
+        for row in xrange(rank, len(m)):
+            if m[row][col] != 0:
+                pivot = row
+                break
+        if pivot is None:
+            continue
+        m[rank], m[pivot] = m[pivot], m[rank]
+        for row in xrange(rank + 1, len(m)):
+            factor = m[row][col] / m[rank][col]
+            if factor != 0:
+                for k in xrange(col, n_cols):
+                    m[row][k] -= factor * m[rank][k]
+        rank += 1
+    return rank
+
+def _nullspace_vector(matrix, d):
+    # returns a non-zero solution of matrix * y = 0, given rank(matrix) = d-1
+    for free in xrange(d):
+        # fix y_free = 1 and solve for the others
+        others = [k for k in xrange(d) if k != free]
+        square = [[row[k] for k in others] for row in matrix]
+        rhs = [-row[free] for row in matrix]
+        solution = _solve(square, rhs)
+        if solution is not None:
+            y = list(solution)
+            y.insert(free, Fraction(1))
+            return y
+    return None
+
+def _affine_dimension(points):
+    if len(points) == 0:
+        return -1
+    origin = points[0]
+    return _rank([[x - o for x, o in zip(point, origin)]
+                  for point in points[1:]])
+
+def _is_bounded(rows, d):
+    # the recession cone {y | A y <= 0} is pointed (rank(A) = d), it is {0}
+    # iff it has no extreme ray, each one being the solution of d - 1 tight
+    # linearly independent rows
+    coefficients = [c for c, _ in rows]
+    for subset in combinations(xrange(len(rows)), d - 1):
+        matrix = [coefficients[i] for i in subset]
+        if d > 1 and _rank(matrix) < d - 1:
+            continue
+        ray = [Fraction(1)] if d == 1 else _nullspace_vector(matrix, d)
+        for direction in [ray, [-y for y in ray]]:
+            if all(sum(a * y for a, y in zip(c, direction)) <= 0
+                   for c in coefficients):
+                return False
+    return True
+
+def _rows(polytope, variables):
+    # list of (coefficients, constant), encoding coefficients * x <= constant
+    return [(tuple(bound.coefficients.get(var, 0) for var in variables),
+             bound.constant) for bound in polytope.polytope]
+
+def _satisfies(rows, point):
+    for coefficients, constant in rows:
+        if sum(a * x for a, x in zip(coefficients, point)) > constant:
+            return False
+    return True
+
+def _is_bounded_2d(rows):
+    # the polygon is bounded iff no direction d != 0 has a * d <= 0 for all
+    # the rows; the extreme rays of such a cone are orthogonal to some a
+    if len(rows) == 0:
+        return False
+    for (a, b), _ in rows:
+        for direction in [(-b, a), (b, -a)]:
+            if all(c[0] * direction[0] + c[1] * direction[1] <= 0
+                   for c, _ in rows):
+                return False
+    return True
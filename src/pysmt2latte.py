@@ -10,11 +10,12 @@ Credits: least common multiple code by J.F. Sebastian
 __version__ = '0.99'
 __author__ = 'Paolo Morettin'
 
+from copy import copy
 from fractions import Fraction
 import networkx as nx
 from pysmt.operators import POW
 from sympy2pysmt import get_canonical_form
-from utils import lcmm
+from utils import lcmm, gcdm
 from wmiexception import WMIParsingError, WMIRuntimeException
 
 # utility unbound methods
@@ -77,6 +78,43 @@ class Polynomial:
         else:
             return 0
 
+    def key(self):
+        """Returns a canonical hashable representation of the polynomial,
+        equal for polynomials having the same monomials up to their order.
+
+        """
+        coefficients = {}
+        for monomial in self.monomials:
+            exponents = monomial.key()
+            coefficients[exponents] = (coefficients.get(exponents, 0) +
+                                       monomial.coefficient)
+
+        return tuple(sorted((exponents, coefficient)
+                            for exponents, coefficient in coefficients.iteritems()
+                            if coefficient != 0))
+
+    def split(self, blocks):
+        """Factorizes each monomial according to a partition of the
+        variables. Returns a list of pairs (coefficient, factors), one for
+        each monomial, where factors is the list of Polynomial instances,
+        one for each block, containing a single monomial with coefficient 1.
+
+        Keyword arguments:
+        blocks -- list of disjoint sets of variable names
+
+        """
+        factorized = []
+        for monomial in self.monomials:
+            factors = []
+            for block in blocks:
+                factor = copy(self)
+                factor.monomials = []
+                factor.variables = set()
+                factor._add_monomial(monomial.restrict(block))
+                factors.append(factor)
+            factorized.append((monomial.coefficient, factors))
+        return factorized
+
     def negate(self):
         """Negates the polinomial by negating all its monomials."""
         for monomial in self.monomials:
@@ -159,6 +197,14 @@ class Monomial:
         """Returns the degree of the monomial."""
         return sum(self.exponents.values())
 
+    def key(self):
+        """Returns the sorted tuple of the (variable, exponent) pairs with
+        non-zero exponent.
+
+        """
+        return tuple(sorted((name, exp) for name, exp in self.exponents.iteritems()
+                            if exp != 0))
+
     def multiply_by_monomial(self, monomial):
         """Multiplies this instance with another monomial.
 
@@ -176,6 +222,21 @@ class Monomial:
         """Negates the monomial by changing the sign of the coefficient."""
         self.coefficient *= -1
 
+    def restrict(self, variables):
+        """Returns a new monomial with coefficient 1, containing only the
+        powers of the given variables.
+
+        Keyword arguments:
+        variables -- set of variable names
+
+        """
+        monomial = copy(self)
+        monomial.coefficient = Fraction(1)
+        monomial.exponents = {name : exp
+                              for name, exp in self.exponents.iteritems()
+                              if name in variables and exp != 0}
+        return monomial
+
     def _parse_term(self, expression):
         if expression.is_real_constant():
             self.coefficient = self.coefficient * expression.constant_value()
@@ -279,6 +340,32 @@ class Bound:
                 "Polynomial not in canonical form"
             self.coefficients[name] = int(monomial.coefficient * lcd)
         self.constant = int(b *lcd)
+
+    def key(self):
+        """Returns a canonical hashable representation of the inequality:
+        the sorted non-zero coefficients and the constant, divided by their
+        greatest common divisor.
+
+        """
+        coefficients = [(name, c) for name, c in self.coefficients.iteritems()
+                        if c != 0]
+        divisor = gcdm([abs(c) for _, c in coefficients] + [abs(self.constant)])
+        if divisor == 0:
+            divisor = 1
+        return (tuple(sorted((name, c // divisor) for name, c in coefficients)),
+                self.constant // divisor)
+
+    def normalize(self):
+        """Divides the coefficients and the constant by their greatest common
+        divisor, in place.
+
+        """
+        divisor = gcdm([abs(c) for c in self.coefficients.itervalues()] +
+                       [abs(self.constant)])
+        if divisor > 1:
+            self.coefficients = {name : c // divisor
+                                 for name, c in self.coefficients.iteritems()}
+            self.constant //= divisor
         
 
 class Polytope(list):
@@ -319,5 +406,59 @@ class Polytope(list):
             for name in bound.coefficients.iterkeys():
                 self.variables.add(name)
 
+    def key(self):
+        """Returns a canonical hashable representation of the polytope, equal
+        for polytopes defined by the same (normalized) set of inequalities.
+
+        """
+        return tuple(sorted(set(bound.key() for bound in self.polytope)))
+
+    def reduce(self):
+        """Normalizes the bounds and removes the duplicate ones, keeping only
+        the tightest bound among the parallel ones, in place. Returns the
+        number of bounds removed.
+
+        """
+        tightest = {}
+        for bound in self.polytope:
+            bound.normalize()
+            coefficients = sorted((name, c) for name, c
+                                  in bound.coefficients.iteritems() if c != 0)
+            divisor = gcdm([abs(c) for _, c in coefficients])
+            direction = tuple((name, c // divisor) for name, c in coefficients)
+            constant = Fraction(bound.constant, divisor)
+            if (not direction in tightest or
+                constant < tightest[direction][0]):
+                tightest[direction] = (constant, bound)
+
+        kept = {id(bound) for _, bound in tightest.itervalues()}
+        n_bounds = len(self.polytope)
+        self.polytope = [bound for bound in self.polytope if id(bound) in kept]
+        return n_bounds - len(self.polytope)
+
+    def split(self):
+        """Returns the list of polytopes whose cartesian product is this
+        polytope, one for each connected component of the graph linking the
+        variables that appear in the same bound.
+
+        """
+        graph = nx.Graph()
+        graph.add_nodes_from(self.variables)
+        for bound in self.polytope:
+            names = [name for name, c in bound.coefficients.iteritems()
+                     if c != 0]
+            graph.add_edges_from(zip(names, names[1:]))
+
+        blocks = []
+        for component in nx.connected_components(graph):
+            block = copy(self)
+            block.variables = set(component)
+            block.polytope = [bound for bound in self.polytope
+                              if any(c != 0 and name in block.variables
+                                     for name, c
+                                     in bound.coefficients.iteritems())]
+            blocks.append(block)
+        return blocks
+
 
 
@@ -1,4 +1,7 @@
 
+from collections import OrderedDict
+from threading import Lock
+
 from pysmt.shortcuts import Symbol
 from pysmt.typing import BOOL, REAL
 
@@ -83,3 +86,59 @@ def lcmm(args):
     """Return lcm of args."""   
     return reduce(_lcm, args)
 
+def gcdm(args):
+    """Return gcd of args."""
+    return reduce(_gcd, args, 0)
+
+
+class LRUCache:
+    """In-memory cache keeping at most max_size entries, evicting the least
+    recently used ones. It can be safely accessed by concurrent threads.
+
+    """
+    # the lock can't be serialized, a new one is created when deserializing
+    def __getstate__(self):
+        d = dict(self.__dict__)
+        del d['lock']
+        return d
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.lock = Lock()
+
+    def __init__(self, max_size):
+        """Default constructor.
+
+        Keyword arguments:
+        max_size -- maximum number of entries
+
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns a pair (hit, value), where hit is True iff the key is in
+        the cache.
+
+        """
+        with self.lock:
+            if not key in self.entries:
+                return False, None
+            # move the entry to the most recently used end
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return True, value
+
+    def put(self, key, value):
+        """Stores the value, evicting the least recently used entry if the
+        cache is full.
+
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
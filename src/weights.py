@@ -1,4 +1,5 @@
 
+from copy import copy
 from itertools import product
 
 from pysmt.shortcuts import And, Iff, Symbol, get_env
@@ -31,10 +32,10 @@ class Weights:
             assert(isinstance(value,bool)), "Assignment value should be Boolean"
             if (atom.is_symbol() and atom.get_type() == BOOL and
                      is_cond_label(atom)):
-                index = int(atom.symbol_name().partition("_")[-1])
-                label_assignment[index] = value
+                label_assignment[Weights._label_index(atom)] = value
             
-        assert(not None in label_assignment),\
+        assert(all(label_assignment[Weights._label_index(label)] != None
+                   for label in self.labels)),\
             "Couldn't retrieve the complete assignment"
         label_assignment = tuple(label_assignment)
         if self.cache != None:
@@ -47,6 +48,27 @@ class Weights:
         else:
             return Weights._evaluate_weight(self.weights, label_assignment)
 
+    def factor(self, labelled_factor):
+        """Returns a Weights instance encoding a factor of the (labelled)
+        weight function, sharing the condition labels with this instance.
+        Its weights only depend on the labels in the factor.
+
+        Keyword arguments:
+        labelled_factor -- pysmt formula, a factor of self.weights
+
+        """
+        weights = copy(self)
+        weights.weights = labelled_factor
+        weights.labels = {label for label in self.labels
+                          if label in labelled_factor.get_free_variables()}
+        definitions = (self.labelling.args() if self.labelling.is_and()
+                       else [self.labelling])
+        weights.labelling = And([iff for iff in definitions
+                                 if len(weights.labels.intersection(
+                                     iff.get_free_variables())) > 0])
+        weights.cache = {} if self.cache != None else None
+        return weights
+
     @staticmethod
     def label_conditions(weight_func):
         # recursively find all the conditions
@@ -74,11 +96,15 @@ class Weights:
             cond_w = Weights._evaluate_weight(self.weights, assignment)
             self.cache[assignment] = cond_w
 
+    @staticmethod
+    def _label_index(label):
+        return int(label.symbol_name().partition("_")[-1])
+
     @staticmethod
     def _evaluate_weight(node, assignment):
         if node.is_ite():
             cond, then, _else = node.args()
-            index_cond = int(cond.symbol_name().partition("_")[-1])
+            index_cond = Weights._label_index(cond)
             if assignment[index_cond]:
                 return Weights._evaluate_weight(then, assignment)
             else:
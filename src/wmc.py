@@ -0,0 +1,212 @@
+"""This module implements the weighted model counting of purely Boolean
+formulas, whose weight function is constant given the truth values of the
+condition labels.
+
+The formula is converted in CNF with the Tseitin encoding, whose auxiliary
+variables are functionally determined by the original ones, hence the
+number of models is preserved. The models are counted by a DPLL-style
+procedure with unit propagation, decomposition into independent components
+and component caching. The search branches on the condition labels first,
+so that the weight is known when the remaining variables are counted.
+Variables not occurring in the clauses contribute a factor 2 each.
+
+"""
+
+__version__ = '0.999'
+__author__ = 'Paolo Morettin'
+
+from pysmt.shortcuts import simplify
+
+from wmiexception import WMIParsingError
+
+
+def count(formula, weights):
+    """Returns the weighted model count of a Boolean formula, i.e. the sum of
+    the (constant) weights of its models over all its variables.
+
+    Keyword arguments:
+    formula -- pysmt formula without real variables
+    weights -- Weights instance, whose weights are constant given the
+        condition labels
+
+    """
+    clauses, variables, n_variables = _encode(formula)
+    for label in weights.labels:
+        if not label in variables:
+            n_variables += 1
+            variables[label] = n_variables
+    labels = [(label, variables[label]) for label in sorted(
+        weights.labels, key=lambda label : label.symbol_name())]
+    # the auxiliary variables are counted as well
+    free = set(xrange(1, n_variables + 1))
+    result = _weighted_count(clauses, free, labels, {}, weights, {})
+    return float(result)
+
+def _weighted_count(clauses, free, labels, assignment, weights, cache):
+    clauses, assigned = _propagate(clauses)
+    if clauses is None:
+        return 0
+    assignment = dict(assignment)
+    for label, index in labels:
+        if index in assigned:
+            assignment[label] = True
+        elif -index in assigned:
+            assignment[label] = False
+    free = free - {abs(literal) for literal in assigned}
+
+    remaining = [(label, index) for label, index in labels
+                 if not label in assignment]
+    if len(remaining) == 0:
+        weight = simplify(weights.weight_from_assignment(assignment))
+        weight = weight.constant_value()
+        if weight == 0:
+            return 0
+        return weight * _count(clauses, free, cache)
+
+    # branch on the next label
+    label, index = remaining[0]
+    result = 0
+    for literal in [index, -index]:
+        conditioned = _condition(clauses, literal)
+        if conditioned is None:
+            continue
+        assignment[label] = literal > 0
+        result += _weighted_count(conditioned, free - {index}, remaining[1:],
+                                  assignment, weights, cache)
+    return result
+
+def _count(clauses, free, cache):
+    # number of models of the clauses over the free variables
+    clauses, assigned = _propagate(clauses)
+    if clauses is None:
+        return 0
+    free = free - {abs(literal) for literal in assigned}
+    occurring = {abs(literal) for clause in clauses for literal in clause}
+    # the variables not occurring in the clauses are don't-cares
+    result = 2 ** len(free - occurring)
+    for component in _components(clauses):
+        key = frozenset(component)
+        if not key in cache:
+            component_variables = {abs(literal) for clause in component
+                                   for literal in clause}
+            variable = _choose_variable(component)
+            cache[key] = sum(_count(_condition(component, literal),
+                                    component_variables - {variable}, cache)
+                             for literal in [variable, -variable])
+        result *= cache[key]
+        if result == 0:
+            return 0
+    return result
+
+def _propagate(clauses):
+    # returns the clauses after unit propagation and the assigned literals,
+    # the clauses are None if a conflict is found
+    assigned = set()
+    while clauses is not None:
+        units = [clause for clause in clauses if len(clause) == 1]
+        if len(units) == 0:
+            break
+        literal, = units[0]
+        assigned.add(literal)
+        clauses = _condition(clauses, literal)
+    return clauses, assigned
+
+def _condition(clauses, literal):
+    # returns the clauses with literal set to True, None if a clause becomes
+    # empty
+    if clauses is None:
+        return None
+    conditioned = []
+    for clause in clauses:
+        if literal in clause:
+            continue
+        elif -literal in clause:
+            clause = clause - {-literal}
+            if len(clause) == 0:
+                return None
+        conditioned.append(clause)
+    return conditioned
+
+def _components(clauses):
+    # splits the clauses into groups not sharing any variable
+    parent = {}
+    def find(x):
+        while parent.get(x, x) != x:
+            x = parent[x]
+        return x
+    for clause in clauses:
+        roots = [find(abs(literal)) for literal in clause]
+        for root in roots[1:]:
+            if root != roots[0]:
+                parent[root] = roots[0]
+    components = {}
+    for clause in clauses:
+        root = find(abs(next(iter(clause))))
+        components.setdefault(root, []).append(clause)
+    return components.values()
+
+def _choose_variable(clauses):
+    # the variable occurring in most clauses
+    occurrences = {}
+    for clause in clauses:
+        for literal in clause:
+            occurrences[abs(literal)] = occurrences.get(abs(literal), 0) + 1
+    return max(occurrences, key=lambda variable : occurrences[variable])
+
+def _encode(formula):
+    # Tseitin encoding, returns the list of clauses (frozensets of non-zero
+    # integers), the dict {pysmt variable : index} and the number of
+    # variables, including the auxiliary ones
+    variables = {}
+    clauses = []
+    literals = {}
+
+    def new_variable():
+        index = len(variables) + len(literals) + 1
+        return index
+
+    def literal(node):
+        if node.is_not():
+            return -literal(node.arg(0))
+        if node in literals:
+            return literals[node]
+        if node.is_symbol():
+            if not node in variables:
+                variables[node] = new_variable()
+            return variables[node]
+
+        if len(node.get_free_variables()) == 0:
+            args = []
+        else:
+            args = [literal(arg) for arg in node.args()]
+        v = new_variable()
+        literals[node] = v
+        if len(node.get_free_variables()) == 0:
+            # ground formula
+            clauses.append([v] if simplify(node).is_true() else [-v])
+        elif node.is_and():
+            clauses.extend([-v, a] for a in args)
+            clauses.append([v] + [-a for a in args])
+        elif node.is_or():
+            clauses.extend([v, -a] for a in args)
+            clauses.append([-v] + args)
+        elif node.is_implies():
+            a, b = args
+            clauses.extend([[-v, -a, b], [v, a], [v, -b]])
+        elif node.is_iff():
+            a, b = args
+            clauses.extend([[-v, -a, b], [-v, a, -b], [v, a, b],
+                            [v, -a, -b]])
+        elif node.is_ite():
+            c, t, e = args
+            clauses.extend([[-v, -c, t], [-v, c, e], [v, -c, -t],
+                            [v, c, -e]])
+        else:
+            raise WMIParsingError("Unhandled formula format", node)
+        return v
+
+    clauses.append([literal(formula)])
+    # tautological clauses are dropped, they don't constrain the models
+    return ([frozenset(clause) for clause in clauses
+             if not any(-l in clause for l in clause)],
+            variables, len(variables) + len(literals))
@@ -14,31 +14,466 @@ Currently, three algorithms are supported:
 __version__ = '0.999'
 __author__ = 'Paolo Morettin'
 
-from math import fsum
+from collections import deque
+from contextlib import contextmanager
+from copy import deepcopy
+from math import ceil, fsum, log, sqrt
 from functools import partial
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from threading import RLock
+from time import time
 
 import mathsat
 from pysmt.shortcuts import *
 from pysmt.typing import BOOL, REAL
 from pysmt.fnode import FNode
+import networkx as nx
 from logger import  get_sublogger
 from integration import Integrator
 from pysmt2latte import Polytope, Polynomial
-from wmiexception import WMIParsingError, WMIRuntimeException
+from wmiexception import WMIParsingError, WMIRuntimeException, \
+    WMITimeoutException
 from weights import Weights
+import wmc
 from utils import is_label, new_wmi_label, \
     get_boolean_variables, get_real_variables
 
 
 # apparently Pool.map requires an unbound top-level method, here it is
 def integrate_worker(obj, integrand_polytope_index):
-    integrand, polytope, index = integrand_polytope_index
-    volume =  obj.integrator.integrate(integrand, polytope, index)
+    """Returns the volume and the dictionary of integration statistics. The
+    volume is None if the deadline expired before the end of the integration.
+
+    """
+    integrand, polytope, index, rel_error, deadline = integrand_polytope_index
+    try:
+        volume, info = obj.integrator.integrate_with_info(integrand, polytope,
+                                                          index, rel_error,
+                                                          deadline)
+    except WMITimeoutException:
+        return None, {}
     if volume == None :
-        return 0.0
+        return 0.0, info
     else:
-        return volume
+        return volume, info
+
+# the WMI instance is installed in each worker when the pool is created,
+# so that it isn't serialized for every single task
+_worker_wmi = None
+
+def _init_pool_worker(obj):
+    global _worker_wmi
+    _worker_wmi = obj
+
+def pool_integrate_worker(integrand_polytope_index):
+    return integrate_worker(_worker_wmi, integrand_polytope_index)
+
+# the enumeration workers are forked with the formula and the weights, which
+# can't be serialized
+_worker_enumeration = None
+# residual formulas memoized by the worker across the second steps of PA
+_worker_residuals = None
+
+def _init_enumeration_worker(obj, formula, weights, mode, split=None):
+    global _worker_enumeration, _worker_residuals
+    # the workers don't fork other processes nor share the solvers
+    obj.parallel_pa = False
+    obj.incremental = None
+    _worker_enumeration = (obj, formula, weights, mode, split)
+    _worker_residuals = {}
+
+def enumeration_worker(cube):
+    """Enumerates the LattE problems of the formula conjoined with the cube,
+    given as a list of (Boolean variable name, value) pairs.
+
+    """
+    obj, formula, weights, mode, split = _worker_enumeration
+    literals = [Symbol(name) if value else Not(Symbol(name))
+                for name, value in cube]
+    collector = ProblemCollector(split)
+    obj._compute_with_mode(mode)(And([formula] + literals), weights,
+                                 collector)
+    return collector.problems
+
+def second_step_worker(boolean_model):
+    """Performs the second step of PA given a model over the Boolean
+    variables, as a pair (list of (name, value) pairs, multiplicity), and
+    returns the LattE problems.
+
+    """
+    obj, formula, weights, _, split = _worker_enumeration
+    literals, multiplicity = boolean_model
+    boolean_assignments = {Symbol(name) : value for name, value in literals}
+    collector = ProblemCollector(split)
+    obj._compute_PA_second_step(formula, weights, boolean_assignments,
+                                collector, _worker_residuals, multiplicity)
+    return collector.problems
+
+
+class ProblemCollector:
+    """Collects the LattE problems generated by an enumeration worker, which
+    are sent back to the main process.
+
+    """
+    def __init__(self, split=None):
+        self.problems = []
+        self.split = split
+
+    def add(self, integrand, polytope, multiplicity=1, tag=False):
+        self.problems.append((integrand, polytope, multiplicity, tag))
+        return True
+
+    def tag(self, assignment):
+        return self.split is not None and assignment.get(self.split) is True
+
+    def expired(self):
+        return False
+
+
+class IncrementalSolver:
+    """Keeps MathSAT solvers in which a base formula, e.g. the support of a
+    model, is asserted once. A formula having all the conjuncts of the base
+    formula is enumerated by pushing a backtrack point, asserting only the
+    other conjuncts and popping it afterwards, hence the preprocessing of
+    the base formula and the clauses learned on it are reused.
+
+    """
+    def __init__(self, base):
+        """Default constructor.
+
+        Keyword arguments:
+        base -- pysmt formula asserted in every solver
+
+        """
+        self.base = base
+        self.base_conjuncts = set(WMI._flatten(base, lambda n : n.is_and()))
+        # {minimize : solver}, minimize being the allsat_minimize_model
+        # option, which can't be changed once the solver is created
+        self.solvers = {}
+        self.n_reuses = 0
+
+    def covers(self, formula):
+        """Returns True iff the formula has all the conjuncts of the base
+        formula.
+
+        """
+        return self.base_conjuncts.issubset(
+            WMI._flatten(formula, lambda n : n.is_and()))
+
+    @contextmanager
+    def asserting(self, formula, minimize=False):
+        """Returns a context manager providing the solver in which the
+        formula, which has to be covered, is asserted.
+
+        Keyword arguments:
+        formula -- pysmt formula
+        minimize -- if True, the solver enumerates minimal models with
+            msat_all_sat (default: False)
+
+        """
+        if not minimize in self.solvers:
+            self.solvers[minimize] = WMI._new_solver(minimize)
+            self.solvers[minimize].add_assertion(self.base)
+        else:
+            self.n_reuses += 1
+        solver = self.solvers[minimize]
+        rest = [conjunct for conjunct
+                in WMI._flatten(formula, lambda n : n.is_and())
+                if not conjunct in self.base_conjuncts]
+        solver.push()
+        try:
+            solver.add_assertion(And(rest))
+            yield solver
+        finally:
+            solver.pop()
+
+
+class VolumeAccumulator:
+    """Collects the LattE problems generated during the enumeration and sums
+    up their volumes.
+
+    Identical problems are integrated only once: their volume is multiplied
+    by the number of times they occur, each occurrence possibly standing for
+    several truth assignments.
+
+    In batch mode, the problems are stored and integrated in parallel once
+    the enumeration is over. In streaming mode, each problem is sent to the
+    integration workers as soon as it is generated and the volumes are
+    summed as they come back, keeping at most a fixed number of problems in
+    flight.
+
+    If a relative error is given, some volumes are estimated: the variance
+    of each estimate is kept in order to compute the standard error of the
+    total volume.
+
+    If a split variable is given, the volume of the truth assignments
+    setting it to True, whose problems are tagged, is summed up as well.
+
+    If a deadline is given, the enumeration is interrupted and the
+    integrations still running are cancelled when the time is over. In batch
+    mode, the integrals with the largest bound on their absolute value are
+    computed first. The integrals left are bounded in order to bound the
+    total volume.
+
+    """
+    # number of pending problems per thread in streaming mode
+    PENDING_PER_THREAD = 4
+
+    def __init__(self, wmi, stream=False, rel_error=None, deadline=None,
+                 split=None):
+        """Default constructor.
+
+        Keyword arguments:
+        wmi -- the WMI instance performing the integrations
+        stream -- if True, integrate the problems while enumerating them
+            (default: False)
+        rel_error -- target relative error of the approximate integrals
+            (optional)
+        deadline -- time (as returned by time.time) at which the
+            computation is interrupted (optional)
+        split -- Boolean variable splitting the truth assignments (optional)
+
+        """
+        self.wmi = wmi
+        self.stream = stream
+        self.rel_error = rel_error
+        self.deadline = deadline
+        self.split = split
+        # True if the enumeration was interrupted by the deadline
+        self.interrupted = False
+        # {key : problem} of the integrals not computed yet, only kept if
+        # there is a deadline
+        self.unfinished = {}
+        self.n_integrations = 0
+        self.n_duplicates = 0
+        # statistics returned by the integrator, e.g. the number of boxes
+        self.integration_statistics = {}
+        # {key : [multiplicity, volume, variance, occurrences, tagged]},
+        # tagged being the multiplicity of the tagged occurrences, volume is
+        # None until computed
+        self.distinct = {}
+        self.problems = []
+        self.pool = None
+        self.owns_pool = False
+        self.pending = deque()
+        self.max_pending = wmi.n_threads * VolumeAccumulator.PENDING_PER_THREAD
+        self.partials = []
+        self.tagged_partials = []
+        # {key : bound on the absolute value of the integral}
+        self.bounds = {}
+
+    def add(self, integrand, polytope, multiplicity=1, tag=False):
+        """Adds a LattE problem to the computation. Returns False iff the
+        deadline expired, in which case the enumeration should be stopped.
+
+        Keyword arguments:
+        integrand -- the polynomial
+        polytope -- the bounds of the integral
+        multiplicity -- the volume is multiplied by this factor, e.g. the
+            number of truth assignments sharing the problem (default: 1)
+        tag -- True iff the truth assignments set the split variable to
+            True, see tag (default: False)
+
+        """
+        self.n_integrations += 1
+        tagged = multiplicity if tag else 0
+        key = (integrand.key(), polytope.key())
+        if key in self.distinct:
+            self.n_duplicates += 1
+            entry = self.distinct[key]
+            entry[0] += multiplicity
+            entry[3] += 1
+            entry[4] += tagged
+            if entry[1] is not None:
+                self._add_volume(entry[1] * multiplicity, entry[1] * tagged)
+            return not self.expired()
+
+        self.distinct[key] = [multiplicity, None, 0.0, 1, tagged]
+        problem = (integrand, polytope, len(self.distinct), self.rel_error,
+                   self.deadline)
+        self.problems.append((key, problem))
+        if self.deadline is not None:
+            self.unfinished[key] = problem
+        if not self.stream:
+            return not self.expired()
+
+        if self.wmi.backend == WMI.BACKEND_SERIAL:
+            for key, problem in self.problems:
+                self._set_volume(key, integrate_worker(self.wmi, problem))
+            self.problems = []
+            return not self.expired()
+
+        if self.pool is None:
+            # small batches are integrated inline in result()
+            if len(self.problems) < self.wmi.min_parallel:
+                return not self.expired()
+            self.pool, self.owns_pool = self.wmi._acquire_pool()
+
+        worker = self.wmi._pool_worker()
+        for key, problem in self.problems:
+            self.pending.append((key, self.pool.apply_async(worker,
+                                                            (problem,))))
+        self.problems = []
+        # collect the oldest results, bounding the memory footprint
+        while len(self.pending) > self.max_pending:
+            key, async_result = self.pending.popleft()
+            self._set_volume(key, async_result.get())
+        return not self.expired()
+
+    def add_count(self, volume, tagged_volume=0.0):
+        """Adds a volume computed without integrating, i.e. the weighted
+        model count of a purely Boolean formula.
+
+        Keyword arguments:
+        volume -- the weighted model count
+        tagged_volume -- the weighted model count of the models setting the
+            split variable to True (default: 0)
+
+        """
+        self.integration_statistics["n_model_counts"] = (
+            self.integration_statistics.get("n_model_counts", 0) + 1)
+        self._add_volume(volume, tagged_volume)
+
+    def tag(self, assignment):
+        """Returns True iff the assignment sets the split variable to True.
+
+        Keyword arguments:
+        assignment -- dict {atom : value}
+
+        """
+        return self.split is not None and assignment.get(self.split) is True
+
+    def expired(self):
+        """Returns True iff the deadline expired, marking the enumeration as
+        interrupted.
+
+        """
+        if self.deadline is not None and time() >= self.deadline:
+            self.interrupted = True
+        return self.interrupted
+
+    def result(self):
+        """Waits for the pending integrations and returns the total volume
+        and the number of integrations performed.
+
+        """
+        while len(self.pending) > 0:
+            key, async_result = self.pending.popleft()
+            self._set_volume(key, async_result.get())
+
+        if self.deadline is not None:
+            # the integrals with the largest bound are computed first, the
+            # bounds are computed while there is time left, the others are
+            # integrated last
+            for key, (integrand, polytope, _, _, _) in self.problems:
+                if time() >= self.deadline:
+                    break
+                self._bound(key, integrand, polytope)
+            self.problems.sort(key=lambda (key, _) : -self.bounds.get(key, 0))
+        keys = [key for key, _ in self.problems]
+        results = self.wmi._parallel_volumes(
+            [problem for _, problem in self.problems])
+        for key, result in zip(keys, results):
+            self._set_volume(key, result)
+        self.problems = []
+        self.close()
+        return fsum(self.partials), self.n_integrations
+
+    def tagged_volume(self):
+        """Returns the volume of the tagged problems, i.e. of the truth
+        assignments setting the split variable to True.
+
+        """
+        return fsum(self.tagged_partials)
+
+    def stderr(self):
+        """Returns the standard error of the total volume, which is 0 if all
+        the volumes were computed exactly.
+
+        """
+        # duplicates share the same estimate, their errors add up linearly
+        return sqrt(fsum(count ** 2 * variance
+                         for count, _, variance, _, _
+                         in self.distinct.itervalues()))
+
+    def progress(self):
+        """Returns the number of integrals computed, the number of integrals
+        left and an upper bound on the absolute value of the volume left,
+        which is infinite if the enumeration was interrupted. After the
+        deadline, the integrals whose bound wasn't computed yet are bounded
+        without linear programming, possibly by infinity.
+
+        """
+        n_left = 0
+        left = []
+        for key, (integrand, polytope, _, _, _) in self.unfinished.iteritems():
+            count, _, _, occurrences, _ = self.distinct[key]
+            n_left += occurrences
+            left.append(count * self._bound(key, integrand, polytope))
+        if self.interrupted:
+            left.append(float("inf"))
+        return self.n_integrations - n_left, n_left, fsum(left)
+
+    def close(self):
+        """Releases the integration workers, terminating them if they were
+        created for this computation only.
+
+        """
+        if self.pool is not None:
+            if self.owns_pool:
+                if len(self.pending) > 0:
+                    self.pool.terminate()
+                else:
+                    self.pool.close()
+                self.pool.join()
+            self.pool = None
+            self.pending.clear()
+
+    def _bound(self, key, integrand, polytope):
+        # the bounds are shared by result and progress, after the deadline
+        # they are given by the bounds on single variables only, no LP is
+        # solved
+        if not key in self.bounds:
+            exact = self.deadline is None or time() < self.deadline
+            self.bounds[key] = self.wmi.integrator.bound(integrand, polytope,
+                                                         exact)
+        return self.bounds[key]
+
+    def _set_volume(self, key, result):
+        volume, info = result
+        if volume is None:
+            # interrupted by the deadline
+            return
+        self.unfinished.pop(key, None)
+        entry = self.distinct[key]
+        entry[2] = info.pop("variance", 0.0)
+        for name, value in info.iteritems():
+            self.integration_statistics[name] = (
+                self.integration_statistics.get(name, 0) + value)
+        entry[1] = volume
+        self._add_volume(volume * entry[0], volume * entry[4])
+
+    def _add_volume(self, volume, tagged_volume=0.0):
+        self.partials = VolumeAccumulator._add_partial(self.partials, volume)
+        if tagged_volume:
+            self.tagged_partials = VolumeAccumulator._add_partial(
+                self.tagged_partials, tagged_volume)
+
+    @staticmethod
+    def _add_partial(partials, volume):
+        # exact running sum (Shewchuk), the partials list stays short
+        result = []
+        for y in partials:
+            if abs(volume) < abs(y):
+                volume, y = y, volume
+            hi = volume + y
+            lo = y - (hi - volume)
+            if lo:
+                result.append(lo)
+            volume = hi
+        result.append(volume)
+        return result
 
 
 class WMI:
@@ -51,6 +486,21 @@ class WMI:
 
     # default number of threads used
     DEF_THREADS = 7
+    # batches with less integrations than this are computed inline
+    DEF_MIN_PARALLEL = 4
+
+    # integration backends
+    BACKEND_PROCESS = "process"
+    BACKEND_THREAD = "thread"
+    BACKEND_SERIAL = "serial"
+    BACKENDS = [BACKEND_PROCESS, BACKEND_THREAD, BACKEND_SERIAL]
+    DEF_BACKEND = BACKEND_PROCESS
+
+    # default number of concurrent asynchronous computations
+    DEF_MAX_QUERIES = 4
+
+    # number of cubes per thread in the parallel enumeration
+    CUBES_PER_THREAD = 4
 
     # the following two methods were overwritten to allow the serialization
     # of the class instances (logger contains unserializable data structures).
@@ -59,35 +509,271 @@ class WMI:
     def __getstate__(self):
         d = dict(self.__dict__)
         del d['logger']
+        d['pool'] = None
+        d['executor'] = None
+        d['incremental'] = None
+        del d['smt_lock']
         return d
     def __setstate__(self, d):
         self.__dict__.update(d) 
+        self.smt_lock = RLock()
     
-    def __init__(self, n_threads=None):
+    def __init__(self, n_threads=None, stream=False, min_parallel=None,
+                 integrator=None, backend=None, max_queries=None,
+                 parallel_enumeration=False, parallel_pa=False):
         """Default constructor.
 
         Keyword arguments:
         n_threads -- number of threads (optional)
+        stream -- if True, the integrals are computed while enumerating the
+            truth assignments (default: False)
+        min_parallel -- minimum number of integrations that are dispatched
+            to the workers, smaller batches are computed inline (optional)
+        integrator -- Integrator instance, e.g. with the cache enabled
+            (optional)
+        backend -- string in WMI.BACKENDS, the integrations are run by a
+            pool of processes, a pool of threads (each one waiting for a
+            LattE subprocess) or sequentially (default: process)
+        max_queries -- maximum number of asynchronous computations running
+            concurrently (optional)
+        parallel_enumeration -- if True, the truth assignments are
+            enumerated by n_threads processes, each one working on disjoint
+            cubes over the Boolean variables (default: False)
+        parallel_pa -- if True, the second steps of PA, one for each
+            Boolean model, are performed by n_threads processes
+            (default: False)
 
         """
         self.logger = get_sublogger(__name__)
-        self.integrator = Integrator()
+        self.integrator = integrator or Integrator()
         self.n_threads = WMI.DEF_THREADS if n_threads == None else n_threads
+        self.stream = stream
+        self.min_parallel = (WMI.DEF_MIN_PARALLEL if min_parallel == None
+                             else min_parallel)
+        self.backend = backend or WMI.DEF_BACKEND
+        if not self.backend in WMI.BACKENDS:
+            msg = "Invalid backend, use one: " + ", ".join(WMI.BACKENDS)
+            self.logger.error(msg)
+            raise WMIRuntimeException(msg)
+        self.pool = None
+        self.max_queries = max_queries or WMI.DEF_MAX_QUERIES
+        self.executor = None
+        self.parallel_enumeration = parallel_enumeration
+        self.parallel_pa = parallel_pa
+        # IncrementalSolver used by the current computation, if any
+        self.incremental = None
+        # serializes the accesses to the pysmt environment, which is not
+        # thread-safe
+        self.smt_lock = RLock()
+        self.statistics = {}
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """Starts the pool of integration workers. The pool is reused by the
+        following calls to compute, until close is called.
+
+        """
+        if self.pool is None and self.backend != WMI.BACKEND_SERIAL:
+            self.logger.debug("Starting {} {} workers".format(self.n_threads,
+                                                              self.backend))
+            self.pool = self._new_pool()
+
+    def close(self):
+        """Waits for the asynchronous computations, if any, and stops the pool
+        of integration workers.
+
+        """
+        if self.executor is not None:
+            self.executor.close()
+            self.executor.join()
+            self.executor = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def submit(self, func, args=(), callback=None):
+        """Runs func(*args) in a thread of the executor, starting the
+        executor and the integration workers if needed. Returns a
+        multiprocessing.pool.AsyncResult instance.
+
+        Keyword arguments:
+        func -- the function to run
+        args -- tuple of positional arguments of func (optional)
+        callback -- called with the result of func when it is ready (optional)
+
+        """
+        if self.executor is None:
+            self.executor = ThreadPool(self.max_queries)
+        self.open()
+        return self.executor.apply_async(func, args, callback=callback)
+
+    def compute_async(self, formula, weights, mode, domA=None, domX=None,
+                      rel_error=None, timeout=None, incremental=None,
+                      split=None, statistics=None, callback=None):
+        """Asynchronous version of compute, returns immediately a
+        multiprocessing.pool.AsyncResult whose get method returns the result
+        of compute.
+
+        Up to max_queries calls run concurrently: their SMT enumerations are
+        serialized, whereas their integrations are interleaved in the shared
+        pool of workers, which bounds the number of concurrent LattE
+        processes to n_threads. The workers stay alive until close is called.
 
-    def compute(self, formula, weights, mode, domA=None, domX=None):
+        Keyword arguments:
+        formula -- pysmt formula
+        weights -- Weights instance encoding the FIUC weight function
+        mode -- string in WMI.MODES
+        domA -- set of pysmt vars encoding the Boolean integration domain (optional)
+        domX -- set of pysmt vars encoding the real integration domain (optional)
+        rel_error -- target relative error, see compute (optional)
+        timeout -- time budget in seconds, see compute (optional)
+        incremental -- IncrementalSolver, see compute (optional)
+        split -- Boolean variable, see compute (optional)
+        statistics -- dict, see compute (optional)
+        callback -- called with the result when it is ready (optional)
+
+        """
+        return self.submit(self.compute, (formula, weights, mode, domA, domX,
+                                          rel_error, timeout, incremental,
+                                          split, statistics), callback)
+
+    def compute(self, formula, weights, mode, domA=None, domX=None,
+                rel_error=None, timeout=None, incremental=None, split=None,
+                statistics=None):
         """Computes WMI(formula, weights, X, A). Returns the result and the
         number of integrations performed.
 
+        Identical integrals are computed only once, the statistics of the
+        call (e.g. the number of duplicates, of integrals over boxes computed
+        natively and of LattE calls) are stored in self.statistics, which is
+        replaced by each call. Concurrent calls should pass their own
+        statistics dict instead, which is updated with the same entries.
+
+        If rel_error is given, the integrals that can't be computed natively
+        are estimated by Monte Carlo sampling, each one up to a standard error
+        of rel_error times its value. The standard error of the result is
+        stored in self.statistics["stderr"].
+
+        If the formula and the weight function split into independent
+        components, not sharing any variable, the result is the product of
+        the WMIs of the components, which are enumerated separately.
+
+        If timeout is given, the computation is interrupted after timeout
+        seconds and the partial sum is returned. The number of integrals
+        computed and left, as well as the interval containing the exact
+        result, are stored in self.statistics ("n_done", "n_left",
+        "bounds"). The interval is infinite if the enumeration of the truth
+        assignments was not completed.
+
+        If a split variable is given, the WMI of (formula & split) is
+        computed as well, by the same enumeration, and stored in
+        self.statistics["split_volume"]. The integrals of the truth
+        assignments setting it to True are shared by the two results.
+
+        If an IncrementalSolver is given, the enumerations of formulas having
+        all the conjuncts of its base formula are performed in its solvers,
+        instead of new ones.
+
         Keyword arguments:
         formula -- pysmt formula
         weights -- Weights instance encoding the FIUC weight function
         mode -- string in WMI.MODES
         domA -- set of pysmt vars encoding the Boolean integration domain (optional)
         domX -- set of pysmt vars encoding the real integration domain (optional)
+        rel_error -- target relative error of the approximate integrals
+            (optional)
+        timeout -- time budget in seconds (optional)
+        incremental -- IncrementalSolver whose base formula is a
+            subformula of formula (optional)
+        split -- Boolean variable of the formula (optional)
+        statistics -- dict updated with the statistics of this call
+            (optional)
+
+        """
+        deadline = time() + timeout if timeout is not None else None
+        accumulators = []
+        try:
+            # the pysmt environment can't be accessed concurrently, whereas
+            # the integrations of concurrent calls can be interleaved
+            with self.smt_lock:
+                self.incremental = incremental
+                factor = self._domain_factor(formula, domA, domX)
+                components, constant = WMI._decompose(formula, weights)
+                self.logger.debug("n_components: {}".format(len(components)))
+                for component_formula, component_weights in components:
+                    component_split = (split if split is not None and split in
+                        component_formula.get_free_variables() else None)
+                    accumulator = VolumeAccumulator(
+                        self, self.stream and deadline is None, rel_error,
+                        deadline, component_split)
+                    accumulators.append(accumulator)
+                    self._enumerate_cells(component_formula, component_weights,
+                                          mode, accumulator)
+                self.incremental = None
+            results = [accumulator.result() for accumulator in accumulators]
+        finally:
+            self.incremental = None
+            for accumulator in accumulators:
+                accumulator.close()
+
+        factor = factor * constant
+        volumes = [volume for volume, _ in results]
+        volume = reduce(lambda x, y : x * y, volumes, factor)
+        n_integrations = sum(n for _, n in results)
+        stats = {"n_integrations" : n_integrations,
+                 "n_duplicates" : 0,
+                 "n_components" : len(components)}
+        relative_variance = 0.0
+        bounds = (factor, factor)
+        for accumulator, component_volume in zip(accumulators, volumes):
+            for name, value in accumulator.integration_statistics.iteritems():
+                stats[name] = stats.get(name, 0) + value
+            stats["n_duplicates"] += accumulator.n_duplicates
+            # the errors of independent factors combine in relative terms
+            if component_volume != 0:
+                relative_variance += (accumulator.stderr() /
+                                      component_volume) ** 2
+            if deadline is not None:
+                n_done, n_left, left = accumulator.progress()
+                stats["n_done"] = (
+                    stats.get("n_done", 0) + n_done)
+                stats["n_left"] = (
+                    stats.get("n_left", 0) + n_left)
+                bounds = WMI._multiply_intervals(
+                    bounds, (component_volume - left, component_volume + left))
+
+        if len(accumulators) == 1:
+            stats["stderr"] = accumulators[0].stderr() * abs(factor)
+        else:
+            stats["stderr"] = abs(volume) * sqrt(relative_variance)
+        if deadline is not None:
+            stats["bounds"] = bounds
+        if split is not None:
+            # the other components are not split
+            stats["split_volume"] = reduce(
+                lambda x, y : x * y,
+                [accumulator.tagged_volume() if accumulator.split is not None
+                 else component_volume for accumulator, component_volume
+                 in zip(accumulators, volumes)], factor)
+        self.logger.debug("Volume: {}, statistics: {}".format(volume, stats))
+        self.statistics = stats
+        if statistics is not None:
+            statistics.update(stats)
+
+        return volume, n_integrations
+
+    def _domain_factor(self, formula, domA, domX):
+        """Checks the integration domain of WMI(formula, weights, X, A) and
+        returns the multiplicative factor of the volume.
 
         """
-            
-        self.logger.debug("Computing WMI with mode: {}".format(mode))
         A = {x for x in get_boolean_variables(formula) if not is_label(x)}
         x = get_real_variables(formula)
         dom_msg = "The domain of integration of the numerical variables" +\
@@ -111,24 +797,166 @@ class WMI:
         if domX != None and not set(domX) == x:
             self.logger.error(dom_msg)
             raise WMIRuntimeException(dom_msg) 
-            
 
+        return factor
+
+    def _enumerate_cells(self, formula, weights, mode, accumulator):
+        """Enumerates the LattE problems of WMI(formula, weights) with the
+        given mode, adding them to the accumulator. Purely Boolean problems
+        are solved by weighted model counting instead.
+
+        """
+        self.logger.debug("Computing WMI with mode: {}".format(mode))
+        compute_with_mode = self._compute_with_mode(mode)
+
+        if (len(get_real_variables(formula)) == 0 and
+            len(get_real_variables(weights.weights)) == 0):
+            # no integrals, the weights are constant given the labels
+            if accumulator.split is not None:
+                accumulator.add_count(
+                    wmc.count(formula, weights),
+                    wmc.count(And(formula, accumulator.split), weights))
+            else:
+                accumulator.add_count(wmc.count(formula, weights))
+            return
+
+        if self.parallel_enumeration and self.n_threads > 1:
+            cubes = self._cubes(formula)
+            if len(cubes) > 1:
+                self._enumerate_cubes(formula, weights, mode, cubes,
+                                      accumulator)
+                return
+
+        compute_with_mode(formula, weights, accumulator)
+
+    def _compute_with_mode(self, mode):
+        """Returns the method enumerating the LattE problems with the given
+        mode.
+
+        """
         compute_with_mode = {WMI.MODE_BC : self._compute_WMI_BC,
                              WMI.MODE_ALLSMT : self._compute_WMI_AllSMT,
                              WMI.MODE_PA : self._compute_WMI_PA}
 
-        try:
-            volume, n_integrations = compute_with_mode[mode](formula, weights)
-        except KeyError:
+        if not mode in compute_with_mode:
             msg = "Invalid mode, use one: " + ", ".join(WMI.MODES)
             self.logger.error(msg)
             raise WMIRuntimeException(msg)
 
-        volume = volume * factor
-        self.logger.debug("Volume: {}, n_integrations: {}".format(
-            volume, n_integrations))
+        return compute_with_mode[mode]
 
-        return volume, n_integrations
+    def _cubes(self, formula):
+        """Returns the list of cubes, i.e. all the assignments to a subset
+        of the Boolean variables of the formula, as lists of (name, value)
+        pairs. Every truth assignment extends exactly one cube.
+
+        """
+        n_cubes = self.n_threads * WMI.CUBES_PER_THREAD
+        n_variables = int(ceil(log(n_cubes, 2)))
+        # the variables of the model are preferred to the labels
+        variables = sorted(get_boolean_variables(formula),
+                           key=lambda var : (is_label(var), var.symbol_name()))
+        cubes = [[]]
+        for var in variables[:n_variables]:
+            cubes = [cube + [(var.symbol_name(), value)]
+                     for cube in cubes for value in [True, False]]
+        return cubes
+
+    def _enumerate_cubes(self, formula, weights, mode, cubes, accumulator):
+        """Enumerates the LattE problems of each cube in a pool of forked
+        processes, adding them to the accumulator as they come back.
+
+        """
+        self.logger.debug("Enumerating {} cubes".format(len(cubes)))
+        pool = Pool(self.n_threads, _init_enumeration_worker,
+                    (self, formula, weights, mode, accumulator.split))
+        try:
+            for problems in pool.imap_unordered(enumeration_worker, cubes):
+                for integrand, polytope, multiplicity, tag in problems:
+                    if not accumulator.add(integrand, polytope,
+                                           multiplicity, tag):
+                        return
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @staticmethod
+    def _decompose(formula, weights):
+        """Splits the conjuncts of the formula and the factors of the weight
+        function into independent components, i.e. sharing no variables.
+        Returns the list of pairs (formula, weights), one for each
+        component, and the product of the constant factors of the weight
+        function, which are not included in any component.
+
+        """
+        conjuncts = WMI._flatten(formula, FNode.is_and)
+        factors = WMI._flatten(weights.weights, FNode.is_times)
+        nodes = conjuncts + factors
+        # bipartite graph linking the conjuncts/factors to their variables
+        graph = nx.Graph()
+        graph.add_nodes_from(xrange(len(nodes)))
+        for i, node in enumerate(nodes):
+            graph.add_edges_from((i, var) for var in node.get_free_variables())
+
+        constant = 1
+        components = []
+        ground = []
+        for component in nx.connected_components(graph):
+            indices = sorted(i for i in component if isinstance(i, int))
+            if len(component) == 1:
+                # ground conjunct or constant factor
+                i = indices[0]
+                if i < len(conjuncts):
+                    ground.append(nodes[i])
+                else:
+                    constant *= simplify(nodes[i]).constant_value()
+                continue
+            components.append(indices)
+
+        if len(components) <= 1:
+            return [(formula, weights)], 1
+
+        # the ground conjuncts are added to the first component
+        components.sort()
+        decomposition = []
+        for n, indices in enumerate(components):
+            component_conjuncts = [nodes[i] for i in indices
+                                   if i < len(conjuncts)]
+            if n == 0:
+                component_conjuncts += ground
+            component_factors = [nodes[i] for i in indices
+                                 if i >= len(conjuncts)]
+            if len(component_factors) == 0:
+                component_weights = weights.factor(Real(1))
+            elif len(component_factors) == 1:
+                component_weights = weights.factor(component_factors[0])
+            else:
+                component_weights = weights.factor(Times(component_factors))
+            decomposition.append((And(component_conjuncts),
+                                  component_weights))
+        return decomposition, constant
+
+    @staticmethod
+    def _flatten(node, is_operator):
+        """Returns the list of arguments of the nested applications of the
+        (associative) operator, e.g. the conjuncts of a conjunction.
+
+        """
+        if is_operator(node):
+            return [arg for child in node.args()
+                    for arg in WMI._flatten(child, is_operator)]
+        else:
+            return [node]
+
+    @staticmethod
+    def _multiply_intervals(first, second):
+        """Returns the interval containing the products of the elements of
+        two intervals, assuming 0 * inf = 0.
+
+        """
+        products = [0 if x == 0 or y == 0 else x * y
+                    for x in first for y in second]
+        return min(products), max(products)
 
     def enumerate_TTAs(self, formula, weights, domA=None, domX=None):
         """Enumerates the total truth assignments for 
@@ -183,6 +1011,17 @@ class WMI:
         - a polynomial integrand
         - a convex polytope.
 
+        """
+        polytope, aliases = WMI._convert_to_polytope(atom_assignments)
+        current_weight = weights.weight_from_assignment(atom_assignments)
+        integrand = Polynomial(current_weight, aliases)
+        return integrand, polytope
+
+    @staticmethod
+    def _convert_to_polytope(atom_assignments):
+        """Returns the convex polytope defined by an assignment and the
+        aliases {variable : expression} defined by its equalities.
+
         """
         bounds = []
         aliases = {}
@@ -209,10 +1048,7 @@ class WMI:
             if atom.is_le() or atom.is_lt():                    
                 bounds.append(atom)
 
-        current_weight = weights.weight_from_assignment(atom_assignments)
-        integrand = Polynomial(current_weight, aliases)
-        polytope = Polytope(bounds, aliases)
-        return integrand, polytope
+        return Polytope(bounds, aliases), aliases
     
     @staticmethod
     def _parse_alias(equality):
@@ -227,9 +1063,10 @@ class WMI:
         return left, right
         
     @staticmethod
-    def _model_iterator_base(formula):
-        solver = Solver(name="msat")
-        solver.add_assertion(formula)
+    def _model_iterator_base(formula, solver=None):
+        if solver is None:
+            solver = Solver(name="msat")
+            solver.add_assertion(formula)
         while solver.solve():
             model = solver.get_model()
             yield model
@@ -241,12 +1078,40 @@ class WMI:
                          for var,val in atom_assignments.iteritems()])))
 
     @staticmethod
-    def _callback(model, converter, result):
+    def _new_solver(minimize=False):
+        if minimize:
+            return Solver(name="msat",
+                          solver_options={"dpll.allsat_minimize_model" : "true"})
+        else:
+            return Solver(name="msat")
+
+    @contextmanager
+    def _asserting(self, formula, minimize=False):
+        """Returns a context manager providing a MathSAT solver in which the
+        formula is asserted, from the IncrementalSolver of the computation
+        if it covers the formula.
+
+        """
+        if self.incremental is not None and self.incremental.covers(formula):
+            with self.incremental.asserting(formula, minimize) as solver:
+                yield solver
+        else:
+            solver = WMI._new_solver(minimize)
+            solver.add_assertion(formula)
+            yield solver
+
+    @staticmethod
+    def _callback(model, converter, handler):
         py_model = [converter.back(v) for v in model]
-        result.append(py_model)
-        return 1
+        # the enumeration is stopped if the handler returns False
+        return 0 if handler(py_model) is False else 1
+
+    def _compute_TTAs(self, formula, weights, handler=None):
+        """Performs AllSMT on the formula. If handler is specified, each TTA
+        is passed to it as soon as it is found, otherwise the TTAs are
+        returned in a list together with the labels.
 
-    def _compute_TTAs(self, formula, weights):
+        """
         labels = {}
         expressions = []
         allsat_variables = set()
@@ -255,20 +1120,22 @@ class WMI:
 
         labelled_formula, pa_vars, labels = WMI.label_formula(formula,
                                                               formula.get_atoms())
-        solver = Solver(name="msat")
-        converter = solver.converter
-        solver.add_assertion(labelled_formula)
         models = []
-        # perform AllSMT on the labelled formula
-        mathsat.msat_all_sat(solver.msat_env(),
-                        [converter.convert(v) for v in pa_vars],
-                        lambda model : WMI._callback(model, converter, models))
+        if handler is None:
+            handler = models.append
+        else:
+            handler = partial(handler, labels=labels)
+        with self._asserting(labelled_formula) as solver:
+            converter = solver.converter
+            # perform AllSMT on the labelled formula
+            mathsat.msat_all_sat(solver.msat_env(),
+                            [converter.convert(v) for v in pa_vars],
+                            lambda model : WMI._callback(model, converter,
+                                                         handler))
         return models, labels
 
-    def _compute_WMI_AllSMT(self, formula, weights):
-        models, labels = self._compute_TTAs(formula, weights)
-        latte_problems = []
-        for index, model in enumerate(models):
+    def _compute_WMI_AllSMT(self, formula, weights, accumulator):
+        def add_tta(model, labels):
             # retrieve truth assignments for the original atoms of the formula
             atom_assignments = {}
             for atom, value in WMI._get_assignments(model).iteritems():
@@ -278,123 +1145,238 @@ class WMI:
 
             integrand, polytope = WMI._convert_to_latte(atom_assignments,
                                                         weights)
-            latte_problems.append((integrand, polytope, index))
+            return accumulator.add(integrand, polytope,
+                                   tag=accumulator.tag(atom_assignments))
 
-        formula_volume = self._parallel_volume_computation(latte_problems)
-        return formula_volume, len(latte_problems)
+        self._compute_TTAs(formula, weights, add_tta)
     
-    def _compute_WMI_BC(self, formula, weights):
-        latte_problems = []
-        for index, model in enumerate(WMI._model_iterator_base(formula)):
-            atom_assignments = {a : model.get_value(a).constant_value()
-                                   for a in formula.get_atoms()}
-            integrand, polytope = WMI._convert_to_latte(atom_assignments,
-                                                               weights)
-            latte_problems.append((integrand, polytope, index))
+    def _compute_WMI_BC(self, formula, weights, accumulator):
+        with self._asserting(formula) as solver:
+            for model in WMI._model_iterator_base(formula, solver):
+                atom_assignments = {a : model.get_value(a).constant_value()
+                                       for a in formula.get_atoms()}
+                integrand, polytope = WMI._convert_to_latte(atom_assignments,
+                                                            weights)
+                if not accumulator.add(integrand, polytope,
+                                       tag=accumulator.tag(atom_assignments)):
+                    break
 
-
-        formula_volume = self._parallel_volume_computation(latte_problems)
-        return formula_volume, len(latte_problems)
-
-    def _compute_WMI_PA(self, formula, weights):
-        latte_problems = []
-        index = 0
+    def _compute_WMI_PA(self, formula, weights, accumulator):
         boolean_variables = get_boolean_variables(formula)
         if len(boolean_variables) == 0:
             # enumerate partial TA over theory atoms
             lab_formula, pa_vars, labels = WMI.label_formula(formula, formula.get_atoms())
             # predicate abstraction on LRA atoms with minimal models
-            solver = Solver(name="msat",
-                        solver_options={"dpll.allsat_minimize_model" : "true"})
-            converter = solver.converter
-            solver.add_assertion(lab_formula)
-            lra_assignments = []
-            mathsat.msat_all_sat(
-                solver.msat_env(),
-                [converter.convert(v) for v in pa_vars],
-                lambda model : WMI._callback(model, converter, lra_assignments))
-            for mu_lra in lra_assignments:                    
-                assignments = {}
-                for atom, value in WMI._get_assignments(mu_lra).iteritems():
-                    if atom in labels:
-                        atom = labels[atom]
-                    assignments[atom] = value
-                    
-                integrand, polytope =  WMI._convert_to_latte(
-                        assignments, weights)
-                latte_problems.append((integrand, polytope, index))
-                index += 1                    
+            handler = partial(WMI._add_lra_model, labels=labels,
+                              atom_assignments={}, weights=weights,
+                              accumulator=accumulator)
+            with self._asserting(lab_formula, minimize=True) as solver:
+                converter = solver.converter
+                mathsat.msat_all_sat(
+                    solver.msat_env(),
+                    [converter.convert(v) for v in pa_vars],
+                    lambda model : WMI._callback(model, converter, handler))
 
         else:
-            solver = Solver(name="msat")
-            converter = solver.converter
-            solver.add_assertion(formula)
+            partial_models = []
+            # perform AllSAT on the Boolean variables with minimal models
+            with self._asserting(formula, minimize=True) as solver:
+                converter = solver.converter
+                mathsat.msat_all_sat(
+                    solver.msat_env(),
+                    [converter.convert(v) for v in boolean_variables],
+                    lambda model : WMI._callback(model, converter,
+                                                 partial_models.append))
+
+            # (assignment, multiplicity) pairs
             boolean_models = []
-            # perform AllSAT on the Boolean variables
-            mathsat.msat_all_sat(
-                solver.msat_env(),
-                [converter.convert(v) for v in boolean_variables],
-                lambda model : WMI._callback(model, converter, boolean_models))
+            for model in partial_models:
+                boolean_models.extend(WMI._complete_boolean_model(
+                    formula, weights, WMI._get_assignments(model),
+                    boolean_variables, accumulator.split))
+
+            msg = "n_partial_models: {}, n_boolean_models: {}"
+            self.logger.debug(msg.format(len(partial_models),
+                                         len(boolean_models)))
+            if (self.parallel_pa and self.n_threads > 1 and
+                len(boolean_models) > 1):
+                self._compute_PA_second_steps(formula, weights,
+                                              boolean_models, accumulator)
+                return
 
-            self.logger.debug("n_boolean_models: {}".format(len(boolean_models)))
+            # the cells of the residual formulas, shared by the Boolean
+            # models simplifying F to the same formula
+            residuals = {}
             # for each boolean assignment mu^A of F        
-            for model in boolean_models:
-                atom_assignments = {}
-                boolean_assignments = WMI._get_assignments(model)
-                atom_assignments.update(boolean_assignments)
-                subs = {k : Bool(v) for k, v in boolean_assignments.iteritems()}
-                f_next = formula
-                # iteratively simplify F[A<-mu^A], getting (possibily part.) mu^LRA
-                while True:            
-                    f_before = f_next
-                    f_next = simplify(substitute(f_before, subs))
-                    lra_assignments, over = WMI._parse_lra_formula(f_next)
-                    subs = {k : Bool(v) for k, v in lra_assignments.iteritems()}
-                    atom_assignments.update(lra_assignments)
-                    if over or (serialize(f_before) == serialize(f_next)):
-                        break
-                
-                if not over:
-                    # predicate abstraction on LRA atoms with minimal models
-                    lab_formula, pa_vars, labels = WMI.label_formula(f_next, f_next.get_atoms())
-                    expressions = []
-                    for k, v in atom_assignments.iteritems():
-                        if k.is_theory_relation():
-                            if v:
-                                expressions.append(k)
-                            else:
-                                expressions.append(Not(k))
-                                                
-                    ssformula = And([lab_formula] + expressions)
-                    secondstep_solver = Solver(name="msat",
-                            solver_options={"dpll.allsat_minimize_model" : "true"})
-                    converter = secondstep_solver.converter
-                    secondstep_solver.add_assertion(ssformula)
-                    ssmodels = []
-                    mathsat.msat_all_sat(
-                            secondstep_solver.msat_env(),
-                            [converter.convert(v) for v in pa_vars],
-                            lambda model : WMI._callback(model, converter, ssmodels))
-                    for ssmodel in ssmodels:                    
-                        secondstep_assignments = {}
-                        for atom, value in WMI._get_assignments(ssmodel).iteritems():
-                            if atom in labels:
-                                atom = labels[atom]
-                            secondstep_assignments[atom] = value
-                        secondstep_assignments.update(atom_assignments)
-                        integrand, polytope =  WMI._convert_to_latte(
-                            secondstep_assignments, weights)
-                        latte_problems.append((integrand, polytope, index))
-                        index += 1                    
-                else:
-                    # integrate over mu^A & mu^LRA
-                    integrand, polytope =  WMI._convert_to_latte(atom_assignments,
-                                                          weights)
-                    latte_problems.append((integrand, polytope, index))
-                    index += 1
+            for boolean_assignments, multiplicity in boolean_models:
+                if accumulator.expired():
+                    break
+                self._compute_PA_second_step(formula, weights,
+                                             boolean_assignments,
+                                             accumulator, residuals,
+                                             multiplicity)
+
+    @staticmethod
+    def _complete_boolean_model(formula, weights, boolean_assignments,
+                                boolean_variables, split=None):
+        """Completes a partial model over the Boolean variables, branching
+        on the unassigned variables that the residual formula F[A<-mu^A] or
+        the weight function depend on, as well as on the split variable.
+        Returns a list of (assignment, multiplicity) pairs, the multiplicity
+        being 2^k for the k variables left unassigned.
+
+        """
+        completed = []
+        stack = [boolean_assignments]
+        while len(stack) > 0:
+            assignments = stack.pop()
+            subs = {k : Bool(v) for k, v in assignments.iteritems()}
+            residual = simplify(substitute(formula, subs))
+            if residual.is_false():
+                continue
+            relevant = set(residual.get_free_variables()) | weights.labels
+            if split is not None:
+                relevant.add(split)
+            unassigned = sorted((v for v in boolean_variables
+                                 if not v in assignments),
+                                key=lambda v : v.symbol_name())
+            branching = [v for v in unassigned if v in relevant]
+            if len(branching) == 0:
+                completed.append((assignments, 2**len(unassigned)))
+                continue
+            for value in [True, False]:
+                extended = dict(assignments)
+                extended[branching[0]] = value
+                stack.append(extended)
+        return completed
+
+    def _compute_PA_second_steps(self, formula, weights, boolean_models,
+                                 accumulator):
+        """Dispatches the second steps of PA, one for each Boolean model, to
+        a pool of forked processes, adding the LattE problems to the
+        accumulator as they come back.
+
+        """
+        models = [([(atom.symbol_name(), value) for atom, value
+                    in boolean_assignments.iteritems()], multiplicity)
+                  for boolean_assignments, multiplicity in boolean_models]
+        chunksize = max(1, len(models) // (self.n_threads *
+                                           WMI.CUBES_PER_THREAD))
+        pool = Pool(self.n_threads, _init_enumeration_worker,
+                    (self, formula, weights, WMI.MODE_PA, accumulator.split))
+        try:
+            for problems in pool.imap_unordered(second_step_worker, models,
+                                                chunksize):
+                for integrand, polytope, multiplicity, tag in problems:
+                    if not accumulator.add(integrand, polytope,
+                                           multiplicity, tag):
+                        return
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _compute_PA_second_step(self, formula, weights, boolean_assignments,
+                                accumulator, residuals=None, multiplicity=1):
+        """Performs the second step of PA given an assignment mu^A to the
+        Boolean variables of the formula.
+
+        Keyword arguments:
+        formula -- pysmt formula
+        weights -- Weights instance
+        boolean_assignments -- dict {Boolean variable : value}
+        accumulator -- the LattE problems are added to it
+        residuals -- dict memoizing the cells of each residual formula
+            F[A<-mu^A], together with the theory atoms it implies (optional)
+        multiplicity -- number of Boolean assignments sharing the residual
+            formula and the weights of mu^A (default: 1)
+
+        """
+        atom_assignments = {}
+        atom_assignments.update(boolean_assignments)
+        subs = {k : Bool(v) for k, v in boolean_assignments.iteritems()}
+        f_next = formula
+        # iteratively simplify F[A<-mu^A], getting (possibily part.) mu^LRA
+        while True:            
+            f_before = f_next
+            f_next = simplify(substitute(f_before, subs))
+            lra_assignments, over = WMI._parse_lra_formula(f_next)
+            subs = {k : Bool(v) for k, v in lra_assignments.iteritems()}
+            atom_assignments.update(lra_assignments)
+            if over or (serialize(f_before) == serialize(f_next)):
+                break
+
+        if not over:
+            key = (f_next, frozenset((k, v) for k, v
+                                     in atom_assignments.iteritems()
+                                     if k.is_theory_relation()))
+            if residuals is not None and key in residuals:
+                # same cells, the weight depends on mu^A
+                for model_assignments, polytope, aliases in residuals[key]:
+                    assignments = dict(model_assignments)
+                    assignments.update(atom_assignments)
+                    weight = weights.weight_from_assignment(assignments)
+                    if not accumulator.add(Polynomial(weight, aliases),
+                                           deepcopy(polytope), multiplicity,
+                                           accumulator.tag(assignments)):
+                        return
+                return
+
+            cells = [] if residuals is not None else None
+            # predicate abstraction on LRA atoms with minimal models
+            lab_formula, pa_vars, labels = WMI.label_formula(f_next, f_next.get_atoms())
+            expressions = []
+            for k, v in atom_assignments.iteritems():
+                if k.is_theory_relation():
+                    if v:
+                        expressions.append(k)
+                    else:
+                        expressions.append(Not(k))
+
+            ssformula = And([lab_formula] + expressions)
+            secondstep_solver = WMI._new_solver(minimize=True)
+            converter = secondstep_solver.converter
+            secondstep_solver.add_assertion(ssformula)
+            handler = partial(WMI._add_lra_model, labels=labels,
+                              atom_assignments=atom_assignments,
+                              weights=weights, accumulator=accumulator,
+                              cells=cells, multiplicity=multiplicity)
+            mathsat.msat_all_sat(
+                    secondstep_solver.msat_env(),
+                    [converter.convert(v) for v in pa_vars],
+                    lambda model : WMI._callback(model, converter, handler))
+            # an interrupted enumeration is incomplete
+            if cells is not None and not accumulator.expired():
+                residuals[key] = cells
+        else:
+            # integrate over mu^A & mu^LRA
+            integrand, polytope =  WMI._convert_to_latte(atom_assignments,
+                                                  weights)
+            accumulator.add(integrand, polytope, multiplicity,
+                            accumulator.tag(atom_assignments))
+
+    @staticmethod
+    def _add_lra_model(model, labels, atom_assignments, weights, accumulator,
+                       cells=None, multiplicity=1):
+        """Converts a (possibly partial) model over the labelled LRA atoms,
+        extended with atom_assignments, and adds it to the accumulator. If
+        cells is a list, the model and its conversion are appended to it.
 
-        formula_volume = self._parallel_volume_computation(latte_problems)
-        return formula_volume, len(latte_problems)
+        """
+        model_assignments = {}
+        for atom, value in WMI._get_assignments(model).iteritems():
+            if atom in labels:
+                atom = labels[atom]
+            model_assignments[atom] = value
+        assignments = dict(model_assignments)
+        assignments.update(atom_assignments)
+        polytope, aliases = WMI._convert_to_polytope(assignments)
+        if cells is not None:
+            # the integrator may reduce the polytope in place
+            cells.append((model_assignments, deepcopy(polytope), aliases))
+        current_weight = weights.weight_from_assignment(assignments)
+        integrand = Polynomial(current_weight, aliases)
+        return accumulator.add(integrand, polytope, multiplicity,
+                               accumulator.tag(assignments))
 
     @staticmethod
     def label_formula(formula, atoms_to_label):
@@ -418,12 +1400,48 @@ class WMI:
 
 
     def _parallel_volume_computation(self, latte_problems):
-        pool = Pool(self.n_threads)
-        integrate_alias = partial(integrate_worker, self)
-        volume = fsum(pool.map(integrate_alias, latte_problems))
-        pool.close()
-        pool.join()
-        return volume
+        return fsum(volume for volume, _
+                    in self._parallel_volumes(latte_problems))
+
+    def _parallel_volumes(self, latte_problems):
+        if (len(latte_problems) < self.min_parallel or
+            self.backend == WMI.BACKEND_SERIAL):
+            return [integrate_worker(self, problem)
+                    for problem in latte_problems]
+
+        pool, owns_pool = self._acquire_pool()
+        try:
+            volumes = pool.map(self._pool_worker(), latte_problems)
+        finally:
+            if owns_pool:
+                pool.close()
+                pool.join()
+        return volumes
+
+    def _acquire_pool(self):
+        """Returns the persistent pool if it is open, a new one otherwise.
+        The second value is True iff the caller is responsible for closing
+        the returned pool.
+
+        """
+        if self.pool is not None:
+            return self.pool, False
+        else:
+            return self._new_pool(), True
+
+    def _new_pool(self):
+        if self.backend == WMI.BACKEND_THREAD:
+            return ThreadPool(self.n_threads)
+        else:
+            return Pool(self.n_threads, _init_pool_worker, (self,))
+
+    def _pool_worker(self):
+        """Returns the function executed by the pool workers."""
+        if self.backend == WMI.BACKEND_THREAD:
+            # threads share the memory, no need for a global instance
+            return partial(integrate_worker, self)
+        else:
+            return pool_integrate_worker
 
     @staticmethod
     def _get_assignments(literals):
@@ -8,24 +8,31 @@ Chi are SMT-LRA formulas.
 __version__ = '0.999'
 __author__ = 'Paolo Morettin'
 
+from time import time
+
 from pysmt.shortcuts import And, Iff, Symbol, serialize
 from pysmt.typing import BOOL, REAL
 
 from logger import Loggable, init_root_logger
 from weights import Weights
-from wmi import WMI
+from wmi import IncrementalSolver, WMI
 from wmiexception import WMIRuntimeException
 from utils import contains_labels, get_boolean_variables, \
-    get_real_variables, is_label, new_query_label
+    get_real_variables, is_label, new_query_label, LRUCache
 
 class WMIInference(Loggable):   
     # default WMI algorithm
     DEF_MODE = WMI.MODE_PA
+    # default time budget of the anytime queries, in seconds
+    DEF_TIMEOUT = 60
+    # default number of normalization constants WMI(E & kb) kept in memory
+    DEF_NORMALIZATION_CACHE_SIZE = 100
 
     MSG_NEGATIVE_RES = "WMI returned a negative result: {}"
     MSG_INCONSISTENT_SUPPORT = "The model is inconsistent"
 
-    def __init__(self, support, weights, check_consistency=False):
+    def __init__(self, support, weights, check_consistency=False, wmi=None,
+                 incremental=False, normalization_cache_size=None):
         """Default constructor.
 
         Keyword arguments: 
@@ -33,6 +40,13 @@ class WMIInference(Loggable):
         support weights -- pysmt formula encoding the FIUC weight function
         check_consistency -- if True, raises a WMIRuntimeException if
             the model is inconsistent (default: False)
+        wmi -- WMI instance used to perform the computations (optional)
+        incremental -- if True, the support is asserted once in incremental
+            solvers, reused by all the queries, whose evidence and query are
+            pushed and popped (default: False)
+        normalization_cache_size -- maximum number of normalization
+            constants WMI(E & kb) kept in memory, reused by the queries with
+            the same evidence (optional)
 
         """
         self.init_sublogger(__name__)
@@ -56,12 +70,56 @@ class WMIInference(Loggable):
         self.logger.debug("Weights: {}".format(serialize(weights)))
 
         # initialize the WMI engine
-        self.wmi = WMI()
+        self.wmi = wmi or WMI()
+        self.incremental = (IncrementalSolver(self.support) if incremental
+                            else None)
+        # {serialized evidence, or None : WMI(E & kb)}, over the Boolean
+        # variables of (E & kb)
+        self.normalization_cache = LRUCache(
+            WMIInference.DEF_NORMALIZATION_CACHE_SIZE
+            if normalization_cache_size is None else normalization_cache_size)
 
         # check support consistency if requested
         if check_consistency and not WMI.check_consistency(support):
             raise WMIRuntimeException(WMIInference.MSG_INCONSISTENT_SUPPORT)
 
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """Starts the integration workers, which are then reused by all the
+        queries until close is called.
+
+        """
+        self.wmi.open()
+
+    def close(self):
+        """Stops the integration workers."""
+        self.wmi.close()
+
+    def perform_query_async(self, query, evidence=None, mode=None,
+                            non_negative=True, joint=False, callback=None):
+        """Asynchronous version of perform_query, returns immediately a
+        multiprocessing.pool.AsyncResult whose get method returns the result
+        of perform_query. Concurrent queries share the integration workers,
+        see WMI.compute_async.
+
+        Keyword arguments:
+        query -- pysmt formula encoding the query
+        evidence -- pysmt formula encoding the evidence (default: None)
+        mode -- string in WMI.MODES to select the method (optional)
+        non_negative -- if True, negative WMI results raise an exception (default: True)
+        joint -- see perform_query (default: False)
+        callback -- called with the result when it is ready (optional)
+
+        """
+        return self.wmi.submit(self.perform_query,
+                               (query, evidence, mode, non_negative, joint),
+                               callback)
 
     # common interface method to all inference engines
     def compute_normalized_probability(self, query, evidence=None):
@@ -69,59 +127,69 @@ class WMIInference(Loggable):
 
     
     def perform_query(self, query, evidence = None, mode = None,
-                      non_negative=True):
+                      non_negative=True, joint=False):
         """Performs a query P(Q). Optional evidence can be specified, performing
         P(Q|E). Returns the probability of the query, calculated as:
 
             P(Q|E) = WMI(Q & E & kb) / WMI(E & kb)
 
         as well as the number of integrations performed.
+
+        WMI(E & kb) is cached, keyed by the evidence (or its absence), and
+        reused by the following queries with the same evidence.
+
+        If joint is True, the two WMIs are computed by a single enumeration
+        of (E & kb), whose truth assignments are split by the truth value of
+        Q, hence the integrals where Q holds are computed only once. This is
+        not needed if WMI(E & kb) is cached.
         
         Keyword arguments:
         query -- pysmt formula encoding the query
         evidence -- pysmt formula encoding the evidence (default: None)
         mode -- string in WMI.MODES to select the method (optional)
         non_negative -- if True, negative WMI results raise an exception (default: True)
+        joint -- if True, compute the two WMIs jointly (default: False)
         """
         mode = mode or WMIInference.DEF_MODE
         evstr = (serialize(evidence) if evidence != None else "None")
         msg = "Computing P(Q|E), Q: {}, E: {}".format(serialize(query),evstr)
         self.logger.debug(msg)
-        query_labels = set()
-        
-        if evidence:
-            # check if evidence contains reserved variable names
-            if contains_labels(evidence):
-                msg = "The evidence contains variables with reserved names."
-                self.logger.error(msg)
-                raise WMIRuntimeException(msg)
-            
-            # label LRA-atoms in the evidence
-            bool_evidence = WMIInference._query_labelling(evidence, query_labels)
-            f_e = And(self.support, bool_evidence)
-        else:
-            f_e = self.support
 
-        if contains_labels(query):
-            msg = "The query contains variables with reserved names."
-            self.logger.error(msg)
-            raise WMIRuntimeException(msg)
-
-        # label LRA-atoms in the query
-        bool_query = WMIInference._query_labelling(query, query_labels)
-        f_e_q = And(f_e, bool_query)
-
-        # extract the domain of integration according to the model,
-        # query and evidence
-        domX = set(get_real_variables(f_e_q))
-        domA = {x for x in get_boolean_variables(f_e_q) if not is_label(x)}
-        self.logger.debug("domX: {}, domA: {}".format(domX, domA))
+        cache_key = serialize(evidence) if evidence != None else None
+        hit, cached = self.normalization_cache.get(cache_key)
+        wmi_e = None
+        n_e = 0
+        if joint and not hit:
+            f_joint, split, domA, domX = self._encode_joint_query(query,
+                                                                  evidence)
+            # compute WMI(E & kb) and WMI(Q & E & kb) together
+            statistics = {}
+            wmi_e, n_e_q = self.wmi.compute(f_joint, self.weights, mode, domA,
+                                            domX, incremental=self.incremental,
+                                            split=split, statistics=statistics)
+            wmi_e_q = statistics["split_volume"]
+        else:
+            f_e, f_e_q, domA, domX = self._encode_query(query, evidence)
+            # compute WMI(Q & E & kb)
+            wmi_e_q, n_e_q = self.wmi.compute(f_e_q, self.weights, mode, domA,
+                                              domX, incremental=self.incremental)
+
+        # WMI(E & kb) is cached over the Boolean variables of (E & kb), the
+        # Boolean domain of the query may be larger
+        factor = 2**len(domA - self._evidence_domain(evidence))
+        if hit:
+            wmi_e = cached * factor
+            self.logger.debug("Cached WMI(E & kb): {}".format(wmi_e))
+        elif wmi_e is not None:
+            self.normalization_cache.put(cache_key, wmi_e / float(factor))
 
-        # compute WMI(Q & E & kb)
-        wmi_e_q, n_e_q = self.wmi.compute(f_e_q, self.weights, mode, domA, domX)
         if wmi_e_q > 0 or (wmi_e_q < 0 and not non_negative):
-            # compute WMI(E & kb)
-            wmi_e, n_e = self.wmi.compute(f_e, self.weights, mode, domA, domX)  
+            if wmi_e is None:
+                # compute WMI(E & kb)
+                wmi_e, n_e = self.wmi.compute(f_e, self.weights, mode, domA,
+                                              domX,
+                                              incremental=self.incremental)
+                self.normalization_cache.put(cache_key, wmi_e / float(factor))
             if wmi_e == 0:
                 msg = "(Knowledge base & Evidence) is inconsistent."
                 self.logger.error(msg)
@@ -147,6 +215,56 @@ class WMIInference(Loggable):
         self.logger.debug(msg.format(normalized_p, n_integrations))
         return normalized_p, n_integrations
 
+    def perform_query_anytime(self, query, evidence=None, mode=None,
+                              timeout=None):
+        """Anytime version of perform_query, assuming a non-negative weight
+        function. Half of the time budget is spent on WMI(Q & E & kb), the
+        rest on WMI(E & kb). Returns an interval (lower, upper) containing
+        P(Q|E), which is a single point if the computation was completed in
+        time, as well as the number of integrations performed.
+
+        Keyword arguments:
+        query -- pysmt formula encoding the query
+        evidence -- pysmt formula encoding the evidence (default: None)
+        mode -- string in WMI.MODES to select the method (optional)
+        timeout -- time budget in seconds (optional)
+
+        """
+        mode = mode or WMIInference.DEF_MODE
+        timeout = WMIInference.DEF_TIMEOUT if timeout is None else timeout
+        deadline = time() + timeout
+        f_e, f_e_q, domA, domX = self._encode_query(query, evidence)
+
+        # compute WMI(Q & E & kb)
+        statistics = {}
+        _, n_e_q = self.wmi.compute(f_e_q, self.weights, mode, domA, domX,
+                                    timeout=timeout / 2.0,
+                                    incremental=self.incremental,
+                                    statistics=statistics)
+        lower_e_q, upper_e_q = statistics["bounds"]
+        # compute WMI(E & kb)
+        statistics = {}
+        _, n_e = self.wmi.compute(f_e, self.weights, mode, domA, domX,
+                                  timeout=max(deadline - time(), 0),
+                                  incremental=self.incremental,
+                                  statistics=statistics)
+        lower_e, upper_e = statistics["bounds"]
+
+        # the weights are non-negative and WMI(Q & E & kb) <= WMI(E & kb)
+        lower_e_q = max(lower_e_q, 0)
+        lower_e = max(lower_e, lower_e_q)
+        if upper_e == 0:
+            msg = "(Knowledge base & Evidence) is inconsistent."
+            self.logger.error(msg)
+            raise WMIRuntimeException(msg)
+
+        lower_p = lower_e_q / upper_e
+        upper_p = min(upper_e_q / lower_e, 1.0) if lower_e > 0 else 1.0
+        n_integrations = n_e_q + n_e
+        msg = "Norm. P(Q|E) in [{}, {}], n_integrations: {}"
+        self.logger.debug(msg.format(lower_p, upper_p, n_integrations))
+        return (lower_p, upper_p), n_integrations
+
     def enumerate_TTAs(self, query, evidence = None):
         """Enumerates the total truth assignments computed for the given query.
         
@@ -160,9 +278,66 @@ class WMIInference(Loggable):
                                                         if evidence != None
                                                         else "None")
         self.logger.debug(msg)
+        f_e, f_e_q, domA, domX = self._encode_query(query, evidence)
+
+        n_ttas_e_q = self.wmi.enumerate_TTAs(f_e_q, self.weights, domA, domX)
+        if n_ttas_e_q > 0:
+            n_ttas_e = self.wmi.enumerate_TTAs(f_e, self.weights, domA, domX)  
+            if n_ttas_e == 0:
+                msg = "(Knowledge base & Evidence) is inconsistent."
+                self.logger.error(msg)
+                raise WMIRuntimeException(msg)
+            
+            return n_ttas_e_q + n_ttas_e
+        else:
+            return 0
+
+    def _encode_query(self, query, evidence):
+        """Labels the LRA atoms in the query and evidence and returns the
+        formulas (E & kb) and (Q & E & kb), as well as the domain of
+        integration of the Boolean and real variables.
+
+        """
+        # the pysmt environment is shared with concurrent computations
+        with self.wmi.smt_lock:
+            f_e, query_labels = self._encode_evidence(evidence)
+            self._check_query(query)
+
+            # label LRA-atoms in the query
+            bool_query = WMIInference._query_labelling(query, query_labels)
+            f_e_q = And(f_e, bool_query)
+            domA, domX = self._domains(f_e_q)
+
+        return f_e, f_e_q, domA, domX
+
+    def _encode_joint_query(self, query, evidence):
+        """Labels the LRA atoms in the query and evidence and returns the
+        formula (E & kb & (q <-> Q)), q being a fresh query label, q, as well
+        as the domain of integration of the Boolean and real variables.
+
+        """
+        # the pysmt environment is shared with concurrent computations
+        with self.wmi.smt_lock:
+            f_e, query_labels = self._encode_evidence(evidence)
+            self._check_query(query)
+
+            # label LRA-atoms in the query and the query itself
+            definitions = WMIInference._query_definitions(query, query_labels)
+            split = new_query_label(len(query_labels))
+            f_joint = And(f_e, definitions, Iff(split, query))
+            domA, domX = self._domains(f_joint)
+
+        return f_joint, split, domA, domX
+
+    def _encode_evidence(self, evidence):
+        """Labels the LRA atoms in the evidence and returns the formula
+        (E & kb) and the set of labels.
+
+        """
         query_labels = set()
 
         if evidence:
+            # check if evidence contains reserved variable names
             if contains_labels(evidence):
                 msg = "The evidence contains variables with reserved names."
                 self.logger.error(msg)
@@ -174,34 +349,37 @@ class WMIInference(Loggable):
         else:
             f_e = self.support
 
+        return f_e, query_labels
+
+    def _evidence_domain(self, evidence):
+        # Boolean domain of integration of (E & kb)
+        with self.wmi.smt_lock:
+            formula = (And(self.support, evidence) if evidence != None
+                       else self.support)
+            return {x for x in get_boolean_variables(formula)
+                    if not is_label(x)}
+
+    def _check_query(self, query):
         if contains_labels(query):
             msg = "The query contains variables with reserved names."
             self.logger.error(msg)
             raise WMIRuntimeException(msg)
 
-        # label LRA-atoms in the query
-        bool_query = WMIInference._query_labelling(query, query_labels)
-        f_e_q = And(f_e, bool_query)
-
+    def _domains(self, formula):
         # extract the domain of integration according to the model,
         # query and evidence
-        domX = set(get_real_variables(f_e_q))
-        domA = {x for x in get_boolean_variables(f_e_q) if not is_label(x)}
-
-        n_ttas_e_q = self.wmi.enumerate_TTAs(f_e_q, self.weights, domA, domX)
-        if n_ttas_e_q > 0:
-            n_ttas_e = self.wmi.enumerate_TTAs(f_e, self.weights, domA, domX)  
-            if n_ttas_e == 0:
-                msg = "(Knowledge base & Evidence) is inconsistent."
-                self.logger.error(msg)
-                raise WMIRuntimeException(msg)
-            
-            return n_ttas_e_q + n_ttas_e
-        else:
-            return 0
+        domX = set(get_real_variables(formula))
+        domA = {x for x in get_boolean_variables(formula) if not is_label(x)}
+        self.logger.debug("domX: {}, domA: {}".format(domX, domA))
+        return domA, domX
 
     @staticmethod
     def _query_labelling(formula, query_labels):
+        return And(formula,
+                   WMIInference._query_definitions(formula, query_labels))
+
+    @staticmethod
+    def _query_definitions(formula, query_labels):
         lra_atoms = [a for a in formula.get_atoms() if a.is_theory_relation()]
         labelling = []
         for lra_atom in lra_atoms:
@@ -209,7 +387,7 @@ class WMIInference(Loggable):
             query_labels.add(q_var)
             labelling.append(Iff(q_var, lra_atom))
                              
-        return And(formula, And(labelling))
+        return And(labelling)
 
 
 if __name__ == "__main__":
@@ -246,4 +424,13 @@ if __name__ == "__main__":
     for query, evidence in suite:
         compute_print(wmi, query, evidence)
 
+    # the joint enumeration must agree with the separate one, in PA mode too
+    for query, evidence in suite:
+        separate, _ = WMIInference(support, weights).perform_query(
+            query, evidence, mode=WMI.MODE_PA)
+        joint, _ = WMIInference(support, weights).perform_query(
+            query, evidence, mode=WMI.MODE_PA, joint=True)
+        print "joint PA: ", joint, "separate PA: ", separate
+        assert abs(joint - separate) <= 1e-9 * max(1.0, abs(separate))
+
     